@@ -10,20 +10,39 @@
 if __name__ == '__main__':
 	from sys import argv
 
+	simulate_from = argv[argv.index('--simulate') + 1] if '--simulate' in argv else None
+		# --simulate <frames dir or video>: run headless, on recorded frames and a fake controller (see simulation)
+
+	export_metrics = '--metrics' in argv
+		# --metrics: write timings and counters to metrics.jsonl and metrics.prom every few seconds (see metrics)
+
+	def start(module, bot_class):
+		if simulate_from is None:
+			bot = bot_class(window = module.window_class_title, macros = module.macros_dd)
+		else:
+			import simulation
+			bot = simulation.simulate(bot_class, simulate_from, macros = module.macros_dd)
+		if export_metrics:
+			bot.export_metrics('metrics.jsonl', 'metrics.prom')
+		try:
+			if simulate_from is None:
+				bot.run()
+			else:
+				print(simulation.run(bot))
+		finally:
+			bot.stop_metrics() # last export, however the bot stopped
+
 	if '--evaluator' in argv:
 		import evaluator_bot as eb
-		bot = eb.EvaluatorBot(window = eb.window_class_title, macros = eb.macros_dd)
-		bot.run()
+		start(eb, eb.EvaluatorBot)
 
 	elif '--logger' in argv:
 		import level_logger as lb
-		bot = lb.LevelLogger(window = lb.window_class_title, macros = lb.macros_dd)
-		bot.run()
+		start(lb, lb.LevelLogger)
 
 	elif '--finder' in argv:
 		import seed_finder as sf
-		bot = sf.SeedFinder(window = sf.window_class_title, macros = sf.macros_dd)
-		bot.run()
+		start(sf, sf.SeedFinder)
 
 	else:
 		print("No valid arguments!")
\ No newline at end of file
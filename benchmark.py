@@ -0,0 +1,404 @@
+# coding: utf-8
+
+# Benchmarks for the parts of a bot's loop that decide how many seeds it gets through:
+#     - template matching, the way each example bot does it (see match_benchmarks()),
+#     - update_view()/update_regions(), i.e. turning captured BGRX frames into BGR views,
+#     - converting recorded XInput states to vJoy states (macro_handler.xinput_macro_to_vjoy_macro()),
+#     - loading macros (the pickle, and the columnar .npz it converts to),
+#     - how late run_macro() issues each update with each scheduler, played on a simulation.FakeVJoyDevice.
+#
+# Frames are synthetic unless a directory of images or a video is given (e.g. recorded with the emulator);
+# nothing here needs Windows, vJoy or a running emulator.
+# Results are written as JSON, so runs on different versions can be compared:
+#
+#     python benchmark.py                                 # -> benchmark_results.json
+#     python benchmark.py --frames recorded_frames -o after.json --compare before.json
+#
+# Every result has a 'seconds' entry, lower being better (per call for throughput, p99 lateness for playback),
+# which is what --compare lines up.
+
+
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from time import perf_counter as _time
+from time import time as _wall_time
+
+import numpy as np
+import cv2
+
+import bot_vision
+import frame_capture
+import macro_format
+import macro_handler
+import simulation
+
+
+
+output_fpath = 'benchmark_results.json'
+macro_fpath = os.path.join('example_configs', 'example_macro_dd.p')
+frame_size = (480, 272) # (w, h) of synthetic frames -- the PSP's screen
+n_frames = 8 # distinct frames cycled through (synthetic, or the first ones read from --frames)
+repeat = 5 # timed runs per benchmark; the median is reported
+n_xinput_states = 10000 # states converted per xinput_macro_to_vjoy_macro() call
+jitter_macro = 'advance_rng_seed' # macro played to measure run_macro() timing
+jitter_seconds = 2.0 # only the first jitter_seconds of it are played (per scheduler)
+seed = 0 # for the synthetic frames and states
+level_logger_batch = 16 # screens per match_many() call, as level_logger.match_batch_size
+pyramid_levels = 2 # as evaluator_bot.pyramid_levels at 4x internal resolution
+pyramid_marker_size = 32 # px -- markers are only searched coarse-to-fine if they're still bot_vision.pyramid_min_size px wide there
+
+
+
+class FrameCycle(frame_capture.CaptureBackend):
+    """Capture backend that hands out the same few BGRX frames in turn, so capture itself costs nothing."""
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = -1
+
+    def grab(self):
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index]
+
+
+
+class _BenchBot(bot_vision.BotView):
+    def run(self):
+        pass
+
+
+
+class _FakeXInputState:
+    """Stand-in for a pyxinput state: __dict__() gives its fields (see macro_handler.xinput_macro_to_columns())."""
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __dict__(self):
+        return dict(self._fields)
+
+
+
+#########
+## FUNCTIONS
+#########
+
+def measure(fn, repeat = repeat):
+    """Time fn() (called enough times per run for the run to take ~0.2 s). Seconds per call, plus calls per second."""
+    timer = timeit.Timer(fn, timer = _time)
+    number, _ = timer.autorange()
+    per_call = sorted(t / number for t in timer.repeat(repeat, number))
+    return {'seconds': per_call[len(per_call) // 2], 'min': per_call[0], 'max': per_call[-1],
+            'per_second': 1.0 / per_call[len(per_call) // 2], 'calls': number * repeat}
+
+
+def synthetic_frames(n = n_frames, size = frame_size):
+    """n BGRX frames with some structure to match against: smoothed noise, a fixed HUD, and boxes that move between frames."""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    frames = []
+    for i in range(n):
+        bgr = cv2.GaussianBlur(rng.integers(0, 256, (h, w, 3), dtype = np.uint8), (7, 7), 0)
+        cv2.rectangle(bgr, (8, 8), (120, 36), (40, 40, 40), -1) # HUD, same place every frame
+        cv2.putText(bgr, "HP 100", (14, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+        for k in range(6):
+            x, y = (37 * k + 23 * i) % (w - 48), (53 * k + 11 * i) % (h - 48)
+            cv2.rectangle(bgr, (x, y), (x + 40, y + 40), tuple(int(c) for c in rng.integers(0, 256, 3)), -1)
+        frames.append(cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA))
+    return frames
+
+
+def recorded_frames(source, n = n_frames):
+    """The first n frames of source (a directory of images or a video), as BGRX."""
+    capture = frame_capture.ReplayCapture(source, loop = False)
+    frames = []
+    while len(frames) < n:
+        index = capture.index
+        frame = capture.grab()
+        if frame is None or capture.index == index: # ran out
+            break
+        frames.append(frame.copy())
+    capture.close()
+    if not frames:
+        raise ValueError("No frames could be read from {0}.".format(source))
+    return frames
+
+
+def make_bot(frames):
+    bot = _BenchBot(window = None, macros = {}, capture_backend = FrameCycle(frames),
+        controller = simulation.FakeVJoyDevice(max_calls = 0))
+    bot.snapshot_writer.close()
+    return bot
+
+
+def crops(frame, n, size, step = 29, prefix = 'crop'):
+    """n size x size patches of frame (BGR) at scattered places, as templates that are known to be in it."""
+    h, w = frame.shape[:2]
+    out = []
+    for k in range(n):
+        x, y = (step * 7 * k) % (w - size), (step * 3 * k + 5) % (h - size)
+        out.append(('{0}_{1}'.format(prefix, k), np.ascontiguousarray(frame[y:y+size, x:x+size])))
+    return out
+
+
+def missing_crops(bot, frames, n, size, threshold):
+    """n size x size patches of frames (BGR) that don't match bot's current view (all score below threshold)."""
+    found = []
+    for (i, frame) in enumerate(frames):
+        candidates = crops(frame, 4 * n, size, step = 41, prefix = 'missing_{0}'.format(i))
+        scores = bot.match_many(candidates, threshold = threshold)
+        found.extend((k, t) for (k, t) in candidates if scores[k] < threshold)
+        if len(found) >= n:
+            return found[:n]
+    raise ValueError("Only {0} of the templates taken from other frames miss the one in view (need {1}).".format(len(found), n))
+
+
+def capture_benchmarks(frames):
+    """update_view() (BGRX -> BGR conversion into the reused view) and update_regions()."""
+    bot = make_bot(frames)
+    h, w = frames[0].shape[:2]
+    bot.regions = {'target': (w // 4, h // 4, w // 2, h // 2)}
+    return {
+        'update_view': measure(bot.update_view),
+        'update_regions': measure(bot.update_regions),
+    }
+
+
+def match_benchmarks(frames):
+    """
+    Template matching as each example bot does it, on one frame:
+        - seed_finder: one small template (match_template()), with its location cached, and found from scratch;
+        - evaluator: a state's markers in one match_many() (plain, and larger ones with and without pyramid search),
+            and contraindicators that all miss with first_hit (the usual case: the whole batch is scored);
+        - level_logger: a batch of whole earlier screens (match_batch_size of them) in one match_many().
+    """
+    bot = make_bot(frames) # (which has already taken its view, of frame bot.capture.index)
+    view = bot.view.copy()
+    others = [cv2.cvtColor(f, cv2.COLOR_BGRA2BGR) for (i, f) in enumerate(frames) if i != bot.capture.index]
+    if not others:
+        raise ValueError("Need at least 2 frames (to take templates that aren't in view from).")
+    results = {}
+
+    (key, target), = crops(view, 1, 32)
+    bot.match_template(target, key = key, threshold = 0.99) # cache its location
+    results['seed_finder_cached'] = measure(lambda: bot.match_template(target, key = key, threshold = 0.99))
+    def uncached():
+        bot.matcher.forget(key)
+        bot.match_template(target, key = key, threshold = 0.99)
+    results['seed_finder_full_search'] = measure(uncached)
+
+    markers = crops(view, 24, 24)
+    bot.match_many(markers, threshold = 0.9)
+    results['evaluator_markers'] = dict(measure(lambda: bot.match_many(markers, threshold = 0.9)), templates = len(markers))
+    def uncached_markers():
+        bot.matcher.forget()
+        bot.matcher.new_frame()
+        bot.match_many(markers, threshold = 0.9)
+    results['evaluator_markers_full_search'] = dict(measure(uncached_markers), templates = len(markers))
+    large_markers = crops(view, 24, pyramid_marker_size, prefix = 'large')
+    def uncached_large_markers():
+        bot.matcher.forget()
+        bot.matcher.new_frame()
+        return bot.match_many(large_markers, threshold = 0.9)
+    results['evaluator_markers_pyramid_baseline'] = dict(measure(uncached_large_markers), templates = len(large_markers))
+    bot.matcher.pyramid_levels = pyramid_levels
+    # (otherwise this would just time the baseline's full searches again)
+    assert all(bot.matcher._can_use_pyramid(template) for (_, template) in large_markers)
+    assert min(uncached_large_markers().values()) >= 0.9 # every one still found coarse-to-fine
+    results['evaluator_markers_pyramid'] = dict(measure(uncached_large_markers), templates = len(large_markers))
+    bot.matcher.pyramid_levels = 0
+
+    contraindicators = missing_crops(bot, others, 12, 24, threshold = 0.95)
+    assert bot.match_many(contraindicators, threshold = 0.95, first_hit = True) is None # every one gets scored
+    def contraindicator_check():
+        bot.matcher.new_frame()
+        bot.match_many(contraindicators, threshold = 0.95, first_hit = True)
+    results['evaluator_contraindicators'] = dict(measure(contraindicator_check), templates = len(contraindicators))
+
+    screens = [('screen_{0}'.format(k), others[k % len(others)]) for k in range(level_logger_batch)]
+    results['level_logger_batch'] = dict(measure(lambda: bot.match_many(screens, threshold = 0.95)), templates = len(screens))
+    return results
+
+
+def xinput_states(n = n_xinput_states):
+    """n random XInput states, shaped like what macro_handler.record_gamepad_reader() records."""
+    rng = np.random.default_rng(seed)
+    buttons = list(macro_handler.xinput_buttons.values())
+    states = []
+    for _ in range(n):
+        fields = {'wButtons': int(sum(b for b in buttons if rng.random() < 0.1))}
+        for axis in macro_handler.axis_mapping:
+            fields[axis] = int(rng.integers(0, 256)) if 'trigger' in axis else int(rng.integers(-32767, 32768))
+        states.append(_FakeXInputState(fields))
+    return states
+
+
+def conversion_benchmarks():
+    """
+    xinput_macro_to_vjoy_macro() on n_xinput_states states.
+    It needs pyvjoy for its structs; without it, the same conversion is timed
+    with macro_format._JoystickPosition (same layout) in their place.
+    """
+    states = xinput_states()
+    try:
+        import pyvjoy._sdk
+        convert = lambda: macro_handler.xinput_macro_to_vjoy_macro(states)
+        struct_type = 'pyvjoy._sdk._JOYSTICK_POSITION_V2'
+    except ImportError:
+        convert = lambda: macro_format.columns_to_states(macro_handler.xinput_macro_to_columns(states), macro_format._JoystickPosition)
+        struct_type = 'macro_format._JoystickPosition'
+    result = measure(convert)
+    result.update(states = len(states), states_per_second = len(states) / result['seconds'], struct_type = struct_type)
+    return {'xinput_macro_to_vjoy_macro': result}
+
+
+def load_benchmarks(fpath = macro_fpath):
+    """Loading the macros in fpath: unpickling everything at once, and the .npz it converts to (opening it, and every macro)."""
+    def load_npz():
+        library = macro_format.MacroLibrary(npz_fpath, struct_type = macro_format._JoystickPosition)
+        for label in library.labels:
+            library[label]
+        library.close()
+    def open_npz():
+        macro_format.MacroLibrary(npz_fpath).close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        npz_fpath = os.path.join(tmp_dir, 'macros.npz')
+        macro_format.convert_pickle(fpath, npz_fpath)
+        return {
+            'load_macro_pickle': measure(lambda: macro_format.load_macro_pickle(fpath)),
+            'open_macro_library': measure(open_npz),
+            'load_macro_library': measure(load_npz),
+        }
+
+
+def schedulers():
+    """name -> scheduler, for every scheduler that works here."""
+    found = {'sleep': macro_handler.SleepScheduler(), 'spin': macro_handler.SpinScheduler()}
+    if hasattr(os, 'timerfd_create'): # (Linux, Python 3.13+)
+        found['timerfd'] = macro_handler.TimerfdScheduler()
+    return found
+
+
+def jitter_benchmarks(fpath = macro_fpath, label = jitter_macro, seconds = jitter_seconds):
+    """
+    run_macro() of the first seconds of macro label (from fpath) on a FakeVJoyDevice, in real time, with each scheduler,
+    both as recorded and coalesced (see macro_handler.coalesce_macro()).
+    'seconds' is the p99 lateness of the updates.
+    """
+    macro = macro_format.load_macro_pickle(fpath)[label]
+    n = sum(1 for t in macro['times'] if t < seconds)
+    macro = {'states': macro['states'][:n], 'times': macro['times'][:n], 'Hz': macro.get('Hz')}
+    results = {}
+    for (name, scheduler) in schedulers().items():
+        for (kind, played) in (('recorded', macro), ('coalesced', macro_handler.coalesce_macro(macro))):
+            stats = macro_handler.run_macro(simulation.FakeVJoyDevice(max_calls = 0), played, scheduler)
+            results['run_macro_{0}_{1}'.format(name, kind)] = {'seconds': stats.p99, 'mean': stats.mean, 'max': stats.max,
+                'updates': stats.n_updates, 'late': stats.n_late, 'late_tolerance': macro_handler.LATE_TOLERANCE}
+    return results
+
+
+def run_all(frames_source = None, macros = macro_fpath):
+    """Every benchmark, plus what it ran on. Returns the JSON-friendly dict that's saved."""
+    frames = synthetic_frames() if frames_source is None else recorded_frames(frames_source)
+    results = {}
+    for (name, run) in (('capture', lambda: capture_benchmarks(frames)), ('matching', lambda: match_benchmarks(frames)),
+            ('conversion', conversion_benchmarks), ('loading', lambda: load_benchmarks(macros)),
+            ('playback', lambda: jitter_benchmarks(macros))):
+        print("Running {0} benchmarks ... ".format(name), end = '')
+        sys.stdout.flush()
+        start = _time()
+        results.update(run())
+        print("done ({0:.1f} s)".format(_time() - start))
+    return {'info': info(frames_source, frames, macros), 'results': results}
+
+
+def info(frames_source, frames, macros):
+    return {
+        'time': _wall_time(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'cv2': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'frames': frames_source or 'synthetic',
+        'frame_size': list(frames[0].shape[1::-1]),
+        'macros': macros,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL,
+            cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(run, fpath = output_fpath):
+    with open(fpath, mode = 'w') as f:
+        json.dump(run, f, indent = 2)
+
+
+def load(fpath):
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def compare(old, new):
+    """Lines comparing each result's 'seconds' in new against old (ratios below 1 are improvements)."""
+    lines = ["{0:<36} {1:>12} {2:>12} {3:>7}".format('benchmark', 'before', 'after', 'ratio')]
+    for (name, result) in new['results'].items():
+        before = old['results'].get(name, {}).get('seconds')
+        after = result['seconds']
+        ratio = "{0:.2f}".format(after / before) if before else '-'
+        lines.append("{0:<36} {1:>12} {2:>12} {3:>7}".format(name, _format_seconds(before), _format_seconds(after), ratio))
+    return lines
+
+
+def report(run):
+    """Lines summarizing run's results."""
+    lines = []
+    for (name, result) in run['results'].items():
+        extra = ''
+        if 'per_second' in result:
+            extra = "{0:.1f}/s".format(result['per_second'])
+        if 'states_per_second' in result:
+            extra = "{0:.0f} states/s".format(result['states_per_second'])
+        elif 'late' in result:
+            extra = "{0} of {1} updates late".format(result['late'], result['updates'])
+        lines.append("{0:<36} {1:>12}  {2}".format(name, _format_seconds(result['seconds']), extra))
+    return lines
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    if seconds < 1e-3:
+        return "{0:.1f} us".format(1e6 * seconds)
+    if seconds < 1:
+        return "{0:.3f} ms".format(1e3 * seconds)
+    return "{0:.3f} s".format(seconds)
+
+
+
+if __name__ == '__main__':
+    from sys import argv
+    frames_source = argv[argv.index('--frames') + 1] if '--frames' in argv else None
+        # --frames <dir or video>: match against recorded frames instead of synthetic ones
+    out = argv[argv.index('-o') + 1] if '-o' in argv else output_fpath
+    previous = argv[argv.index('--compare') + 1] if '--compare' in argv else None
+        # --compare <earlier results .json>: print each result next to the earlier one
+
+    run = run_all(frames_source)
+    save(run, out)
+    print('\n'.join(report(run)))
+    if previous is not None:
+        print()
+        print('\n'.join(compare(load(previous), run)))
+    print("Saved to {0}.".format(out))
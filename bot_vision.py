@@ -17,22 +17,31 @@
 
 
 
-import win32gui
-import win32ui
-from ctypes import windll
 from PIL import Image
-    # take screenshots (even if the window is minimized)
-    # and handle them as PIL.Image objects
+    # handle screenshots as PIL.Image objects
+import frame_capture
+    # take screenshots (even if the window is minimized), or replay recorded frames
 
 
+import os
+    # sizing the match_many() thread pool
 import sys
     # make printed text more timely by flushing buffer
+from time import perf_counter as _time
+    # timing capture and template matching (see metrics)
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+    # cv2.matchTemplate releases the GIL, so batches of templates can be matched in parallel
 import numpy as np
     # to flip RGB capture to BGR, for cv2
-import pyvjoy
-    # give bot a controller (need to wrap with XOutput!)
+import cv2
+    # template matching
 import macro_handler
     # access to run_macro() method (and all its dependencies)
+import snapshots
+    # save views to disk in the background
+import metrics
+    # time each phase of the bot's loop
 
 
 
@@ -40,6 +49,26 @@ import macro_handler
 
 
 
+######
+## Variables
+######
+
+max_index = 1 # index of max_value for tuple returned by cv2.minMaxLoc()
+max_loc_index = 3 # index of max_loc for tuple returned by cv2.minMaxLoc()
+roi_padding = 8 # pixels around a template's last match location to search first
+default_threshold = 0.90 # minimum match value for a cached location to count as a hit
+pyramid_candidates = 3 # coarse-level peaks refined at full resolution in pyramid mode
+pyramid_min_size = 8 # templates smaller than this (in px, at the coarsest level) skip pyramid mode
+match_workers = None # threads used by BotView.match_many(); None -> os.cpu_count(), 1 -> match serially
+coalesce_macros = True # play macros with runs of repeated states collapsed (see macro_handler.coalesce_macro())
+checkpoint_poll_interval = 0.005 # seconds between frames checked while waiting for a macro checkpoint
+checkpoint_timeout = 10.0 # seconds to wait for a macro checkpoint that doesn't give its own 'timeout'
+watch_interval = 0.02 # seconds between frames checked by BotView.run_macro_watched()
+first_frame_timeout = 10.0 # seconds update_view() waits for background capture's first frame
+
+
+
+
 ######
 ## Functions/Classes
 ######
@@ -63,6 +92,8 @@ def get_screenshot(class_title, just_display = True):
     
     Adapted from https://stackoverflow.com/questions/19695214/python-screenshot-of-inactive-window-printwindow-win32gui
 
+    For repeated captures, keep a frame_capture.Win32Capture around instead
+    (this sets up and tears down a whole capture session every call).
     """
     # Windows spends less resources on the window, making "screenshots" impossible.
     # Potential workaround is explicitly restore a window with zero opacity,
@@ -72,64 +103,204 @@ def get_screenshot(class_title, just_display = True):
     # in order to restore/minimize the window "quietly".
     # It appears pywin32 would have access to these enums
     # but we'll go with this for now)
+    session = frame_capture.Win32Capture(class_title, just_display)
+    try:
+        bgrx = session.grab()
+        h, w = bgrx.shape[:2]
+        return Image.frombytes('RGB', (w, h), bgrx.tobytes(), 'raw', 'BGRX', 0, 1)
+    finally:
+        session.close()
 
 
 
-    # class titles (first argument) don't usually change, unlike window titles (the second argument)
-    hwnd = win32gui.FindWindow(class_title, None) 
-
-    # get coords
-    if just_display:
-        left,top,right,bot = win32gui.GetClientRect(hwnd)
-    else:
-        left, top, right, bot = win32gui.GetWindowRect(hwnd)
-    # (without check, we'd have extra black space in our screenshots if we wanted just the display)
-    
-    # get lengths
-    w = right - left
-    h = bot - top
-
-    hwndDC = win32gui.GetWindowDC(hwnd) # get the device context ("DC") for window
-        # the window device context we get from win32gui is just an int used to pass into WinDLLs
-        # (the handle)
-        # we need to create our own handle that we can work with
-        # using win32ui
-    mfcDC = win32ui.CreateDCFromHandle(hwndDC) # type(mfcDC) -> <class 'PyCDC'>
-    saveDC = mfcDC.CreateCompatibleDC()
-        # making a new context to be a bitmap container
-        # should be compatible with the source of the bitmap (hence mfcDC)
-
-    saveBitMap = win32ui.CreateBitmap()
-    saveBitMap.CreateCompatibleBitmap(mfcDC, w, h) # take the screenshot, dump into saveBitMap
 
-    saveDC.SelectObject(saveBitMap) # attach context to screenshot
 
+class TemplateMatcher:
+    """
+    Template matching (cv2.TM_CCOEFF_NORMED) that remembers where each template last matched.
+
+    HUD elements and other fixed-position markers sit on the same pixels every time,
+    so a template that has matched before is first searched for within a small padded region
+    around its last location. Only when that misses is the whole frame searched.
+    Since TM_CCOEFF_NORMED is normalized per window, a hit within the region
+    has exactly the value the full search would have given at that location.
+
+    With pyramid_levels > 0, full searches are done coarse-to-fine:
+    the frame and template are downsampled pyramid_levels times (halving each time),
+    the best pyramid_candidates peaks of the coarse match are kept,
+    and each is refined at full resolution within a small neighborhood.
+    Returned values are always full-resolution match values, so thresholds mean the same thing
+    (though a true peak the coarse pass ranks poorly can be missed).
+    """
+    def __init__(self, pad = roi_padding, threshold = default_threshold, pyramid_levels = 0):
+        self.pad = pad
+        self.threshold = threshold
+        self.pyramid_levels = pyramid_levels
+        self.last_locs = {} # key -> (x, y) of last match (top-left corner)
+        self.roi_hits = 0
+        self.full_searches = 0
+        self._coarse_templates = {} # (key, levels) -> downsampled template
+        self._coarse_view = None # (source view, levels, downsampled view)
+        self._coarse_view_lock = threading.Lock() # so parallel matches downsample each frame once
+        self._counts_lock = threading.Lock() # match_many() matches from several threads at once
+
+    def new_frame(self):
+        """Call whenever the view's contents change (e.g. it was refilled in place)."""
+        self._coarse_view = None
+
+    def match(self, view, template, key = None, threshold = None, origin = (0, 0)):
+        """
+        Match template against view.
+        Inputs:
+            - key: identifies the template between calls (e.g. its filename). Defaults to id(template).
+            - threshold: minimum value for a match near the cached location to be accepted
+                (and for a location to be cached). Defaults to self.threshold.
+            - origin: (x, y) of view's top-left corner in the full frame, if view is just a captured region.
+                Locations (cached and returned) are always in full-frame coordinates.
+        Returns:
+            (max_val, max_loc) as cv2.minMaxLoc() would give over the whole view.
+        """
+        if key is None:
+            key = id(template)
+        if threshold is None:
+            threshold = self.threshold
+        ox, oy = origin
+
+        loc = self.last_locs.get(key)
+        roi = self._roi(view, template, None if loc is None else (loc[0] - ox, loc[1] - oy))
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            res = cv2.minMaxLoc(cv2.matchTemplate(view[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED))
+            max_val, max_loc = res[max_index], res[max_loc_index]
+            if max_val >= threshold:
+                with self._counts_lock:
+                    self.roi_hits += 1
+                max_loc = (max_loc[0] + x0 + ox, max_loc[1] + y0 + oy)
+                self.last_locs[key] = max_loc
+                return max_val, max_loc
+
+        # no cached location (or it moved) -- search everything
+        with self._counts_lock:
+            self.full_searches += 1
+        if self._can_use_pyramid(template):
+            max_val, max_loc = self._pyramid_search(view, template, key)
+        else:
+            res = cv2.minMaxLoc(cv2.matchTemplate(view, template, cv2.TM_CCOEFF_NORMED))
+            max_val, max_loc = res[max_index], res[max_loc_index]
+        max_loc = (max_loc[0] + ox, max_loc[1] + oy)
+        if max_val >= threshold:
+            self.last_locs[key] = max_loc
+        else:
+            self.last_locs.pop(key, None)
+        return max_val, max_loc
+
+    def forget(self, key = None):
+        """Drop the cached location for key (or for all templates if key is None)."""
+        if key is None:
+            self.last_locs.clear()
+        else:
+            self.last_locs.pop(key, None)
+
+    def _can_use_pyramid(self, template):
+        scale = 1 << self.pyramid_levels
+        return self.pyramid_levels > 0 and min(template.shape[:2]) // scale >= pyramid_min_size
+
+    def _downsample(self, im):
+        for _ in range(self.pyramid_levels):
+            im = cv2.pyrDown(im)
+        return im
+
+    def _pyramid_search(self, view, template, key):
+        """Coarse-to-fine search. Returns (max_val, max_loc) at full resolution."""
+        levels = self.pyramid_levels
+        scale = 1 << levels
+
+        with self._coarse_view_lock:
+            if self._coarse_view is None or self._coarse_view[0] is not view or self._coarse_view[1] != levels:
+                self._coarse_view = (view, levels, self._downsample(view))
+            coarse_view = self._coarse_view[2]
+        coarse_template = self._coarse_templates.get((key, levels))
+        if coarse_template is None:
+            coarse_template = self._coarse_templates[(key, levels)] = self._downsample(template)
+
+        if coarse_template.shape[0] > coarse_view.shape[0] or coarse_template.shape[1] > coarse_view.shape[1]:
+            res = cv2.minMaxLoc(cv2.matchTemplate(view, template, cv2.TM_CCOEFF_NORMED))
+            return res[max_index], res[max_loc_index]
+        coarse_res = cv2.matchTemplate(coarse_view, coarse_template, cv2.TM_CCOEFF_NORMED)
+
+        # refine the best few coarse peaks; the neighborhood covers the rounding of each pyrDown
+        h, w = template.shape[:2]
+        view_h, view_w = view.shape[:2]
+        best_val, best_loc = -1.0, (0, 0)
+        for _ in range(pyramid_candidates):
+            res = cv2.minMaxLoc(coarse_res)
+            (cx, cy) = res[max_loc_index]
+            x0, y0 = max(cx * scale - scale, 0), max(cy * scale - scale, 0)
+            x1, y1 = min((cx + 1) * scale + scale + w, view_w), min((cy + 1) * scale + scale + h, view_h)
+            x0, y0 = min(x0, x1 - w), min(y0, y1 - h)
+            res = cv2.minMaxLoc(cv2.matchTemplate(view[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED))
+            if res[max_index] > best_val:
+                best_val, best_loc = res[max_index], (res[max_loc_index][0] + x0, res[max_loc_index][1] + y0)
+            # suppress this peak before looking for the next
+            coarse_res[max(cy - 1, 0):cy + 2, max(cx - 1, 0):cx + 2] = -1.0
+        return best_val, best_loc
+
+    def _roi(self, view, template, loc):
+        """Padded (x0, y0, x1, y1) around loc, or None if there's no loc or the region would be the whole view."""
+        if loc is None:
+            return None
+        h, w = template.shape[:2]
+        view_h, view_w = view.shape[:2]
+        x0, y0 = max(loc[0] - self.pad, 0), max(loc[1] - self.pad, 0)
+        x1, y1 = min(loc[0] + w + self.pad, view_w), min(loc[1] + h + self.pad, view_h)
+        if (x1 - x0) < w or (y1 - y0) < h: # frame shrank (or region moved) since the last match
+            return None
+        if (x0, y0, x1, y1) == (0, 0, view_w, view_h): # nothing to gain
+            return None
+        return (x0, y0, x1, y1)
+
+
+
+
+
+class _CheckpointHandoff:
+    """
+    Hands a background macro's checkpoints over to whoever's watching the screen (see BotView.run_macro_watched()),
+    so frames are only ever grabbed on one thread. wait() is the player thread's checkpoint_wait:
+    it blocks until the watcher, having seen pending(), calls resolve() (or cancel(), which gives up on everything).
+    passed counts checkpoints seen so far.
+    """
+    def __init__(self):
+        self.passed = 0
+        self._cond = threading.Condition()
+        self._pending = None # checkpoint the player is waiting on
+        self._seen = None # the watcher's answer for it
+        self._cancelled = False
 
-    # Change the line below depending on whether you want the whole window (0)
-    # or just the client area, i.e. no top menu, title bar, etc. (1) 
-    result = windll.user32.PrintWindow(hwnd, saveDC.GetSafeHdc(), just_display)
-    # result = windll.user32.PrintWindow(hwnd, saveDC.GetSafeHdc(), 0)
-    # print(result)
+    def wait(self, checkpoint):
+        with self._cond:
+            self._pending, self._seen = checkpoint, None
+            self._cond.wait_for(lambda: self._seen is not None or self._cancelled)
+            seen = bool(self._seen) and not self._cancelled
+            self._pending = None
+            if seen:
+                self.passed += 1
+            return seen
 
-    bmpinfo = saveBitMap.GetInfo()
-    bmpstr = saveBitMap.GetBitmapBits(True)
-        # dump bitmap DC into a str to save into an Image module
+    def pending(self):
+        """The checkpoint the player is waiting on (None if it isn't)."""
+        with self._cond:
+            return self._pending if self._seen is None else None
 
-    im = Image.frombuffer(
-        'RGB',
-        (bmpinfo['bmWidth'], bmpinfo['bmHeight']),
-        bmpstr, 'raw', 'BGRX', 0, 1)
-        # can now edit im (to e.g. crop to only save certain part of image)
+    def resolve(self, seen):
+        with self._cond:
+            self._seen = seen
+            self._cond.notify_all()
 
-    # remove our temporary objects to avoid a memory leak
-    win32gui.DeleteObject(saveBitMap.GetHandle())
-    # declutter the device contexts (before we lose the information and they stick around for no reason)
-    saveDC.DeleteDC()
-    mfcDC.DeleteDC()
-        # we needed to hold onto the original window in order to perform operations on it (through mfcDC)
-        # but now we can let it go
-    win32gui.ReleaseDC(hwnd, hwndDC)
-    return im
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
 
 
 
@@ -137,38 +308,339 @@ def get_screenshot(class_title, just_display = True):
 
 class BotView:
     """Bot that can look at a window, has a vjoy device bound to it, and can perform macros.
-    No built-in AI -- need to implement BotView.run() (adding methods, attributes, etc.) in derived classes."""
-    def __init__(self, window, macros, vjoy_device_num = 1):
+    No built-in AI -- need to implement BotView.run() (adding methods, attributes, etc.) in derived classes.
+
+    Frames come from capture_backend (a frame_capture.CaptureBackend);
+    by default, a frame_capture.Win32Capture of the window with class title window.
+    Macros are played on controller (anything shaped like pyvjoy.VJoyDevice, e.g. a simulation.FakeVJoyDevice);
+    by default, vJoy device number vjoy_device_num. They're timed by self.scheduler (None -> macro_handler.default_scheduler)."""
+    def __init__(self, window, macros, vjoy_device_num = 1, capture_backend = None, controller = None):
         self.window = window
-        self.view = self.update_view()
-        self.controller = pyvjoy.VJoyDevice(vjoy_device_num)
+        self.capture = capture_backend if capture_backend is not None else frame_capture.Win32Capture(window)
+        self.matcher = TemplateMatcher()
+        self.match_workers = match_workers
+        self._match_pool = None
+        self.capture_thread = None
+        self.view = None
+        self.regions = {} # name -> (x, y, w, h) to capture with update_regions()
+        self.region_views = {} # name -> (BGR np.ndarray, (x, y)) as of the last update_regions()
+        self.snapshot_writer = snapshots.SnapshotWriter()
+        self.metrics = metrics.Metrics()
+        matcher, snapshot_writer = self.matcher, self.snapshot_writer # (gauges mustn't hold on to self: see export_metrics())
+        self.metrics.gauges.update({
+            'match_roi_hits': lambda: matcher.roi_hits,
+            'match_full_searches': lambda: matcher.full_searches,
+            'snapshots_written': lambda: snapshot_writer.n_written,
+            'snapshot_write_latency_max_seconds': lambda: snapshot_writer.max_latency})
+        self.metrics_exporter = None
+        self.update_view()
+        if controller is None:
+            import pyvjoy
+                # give bot a controller (need to wrap with XOutput!) -- Windows-only, so imported only when needed
+            controller = pyvjoy.VJoyDevice(vjoy_device_num)
+        self.controller = controller
+        self.scheduler = None
         self.macros = macros
+        self._playback_macros = {} # macro label -> macro as played (see _playback_macro())
+        self._checkpoint_templates = {} # template path -> template, for macro checkpoints
+        self._checkpoint_view = None # BGR buffer a checkpoint's region is captured into
+        self.player = None # macro_handler.MacroPlayer, once a macro has been started in the background
+        self.reporter = None # reporter(kind, data) is passed everything report()ed (see orchestrator)
+        self.interactive = True # whether there's someone at the console to ask (see orchestrator)
     
-    def update_view(self):
-        """Update the bot's current view of the game."""
-        # im = get_screenshot(self.window) # currently RGB PIL Image
-#         if debug:
-#             im.show()
-        # convert to cv2 standard -- i.e., np.ndarray in BGR order
-        self.view = np.array(get_screenshot(self.window))[:,:,::-1] # keep x and y coords same, step through the third dimension backward (RGB -> BGR)
+    def update_view(self, newer_than = None):
+        """Update the bot's current view of the game.
+
+        If background capture is running (see start_background_capture()), takes the latest captured frame,
+        or, if newer_than is given, the first frame captured after time newer_than (time.perf_counter())."""
+        start = _time()
+        if self.capture_thread is not None:
+            if newer_than is None:
+                _, frame = self.capture_thread.latest(out = self.view)
+                if frame is None: # nothing captured yet -- wait for the first frame
+                    _, frame = self.capture_thread.first_after(float('-inf'), timeout = first_frame_timeout, out = self.view)
+            else:
+                _, frame = self.capture_thread.first_after(newer_than, out = self.view)
+            if frame is None:
+                if self.capture_thread.is_alive() and self.capture_thread.error is None:
+                    raise RuntimeError("Background capture hasn't produced a frame in {0} s.".format(first_frame_timeout))
+                raise RuntimeError("Background capture has stopped.") from self.capture_thread.error
+            self.view = frame
+            self.matcher.new_frame()
+            self.metrics.observe('capture', _time() - start)
+            return
+
+        # capture gives BGRX; repack it into the cv2 standard -- i.e., a C-contiguous np.ndarray in BGR order
+        # (a strided view would make cv2 copy the frame again inside every matchTemplate call)
+        # self.view is refilled in place, so copy() it if it needs to outlive the next update_view()
+        bgrx = self.capture.grab()
+        if self.view is None or self.view.shape[:2] != bgrx.shape[:2]:
+            self.view = np.empty(bgrx.shape[:2] + (3,), dtype = np.uint8)
+        cv2.cvtColor(bgrx, cv2.COLOR_BGRA2BGR, dst = self.view)
+        self.matcher.new_frame()
+        self.metrics.observe('capture', _time() - start)
+
+    def update_regions(self):
+        """Capture just the rectangles in self.regions (instead of the whole window) into self.region_views.
+        Match against them by passing region = name to match_template()/match_many().
+        Like self.view, the arrays are refilled in place.
+        While background capture is running, the regions are sliced out of its latest frame instead
+        (it's using the capture backend)."""
+        if self.capture_thread is not None:
+            self.update_view()
+            for (name, (x, y, w, h)) in self.regions.items():
+                self.region_views[name] = (self.view[y:y+h, x:x+w], (x, y))
+            return
+        start = _time()
+        grabbed = self.capture.grab_regions(self.regions)
+        for (name, bgrx) in grabbed.items():
+            prev = self.region_views.get(name)
+            if prev is None or prev[0].shape[:2] != bgrx.shape[:2]:
+                prev = (np.empty(bgrx.shape[:2] + (3,), dtype = np.uint8), None)
+            cv2.cvtColor(bgrx, cv2.COLOR_BGRA2BGR, dst = prev[0])
+            self.region_views[name] = (prev[0], tuple(self.regions[name][:2]))
+        self.matcher.new_frame()
+        self.metrics.observe('capture_regions', _time() - start)
+
+    def start_background_capture(self, n_frames = 8, interval = 0.0):
+        """Keep capturing frames on a separate thread (e.g. while macros play) into a ring of n_frames.
+        See frame_capture.CaptureThread; it's available as self.capture_thread."""
+        if self.capture_thread is None:
+            self.capture_thread = frame_capture.CaptureThread(self.capture, n_frames, interval)
+            self.capture_thread.start()
+
+    def stop_background_capture(self):
+        """Go back to capturing synchronously in update_view()."""
+        if self.capture_thread is not None:
+            self.capture_thread.stop()
+            self.capture_thread = None
+
+    def match_template(self, template, key = None, threshold = None, region = None):
+        """Return the max value of cv2.matchTemplate(self.view, template), checking template's last known location first.
+        See TemplateMatcher.match() for key and threshold.
+        If region is given, matches against self.region_views[region] instead of self.view."""
+        view, origin = self._match_target(region)
+        return self._match(view, template, key, threshold, origin)[0]
+
+    def match_many(self, templates, threshold = None, first_hit = False, region = None):
+        """
+        Match a batch of templates against the current view, spread over a pool of self.match_workers threads.
+        Inputs:
+            - templates: iterable of (key, template) pairs.
+            - threshold, region: as in match_template().
+            - first_hit: if True, stop as soon as any template reaches threshold.
+        Returns:
+            a dict of key -> max value if first_hit is False;
+            otherwise the key of a template that reached threshold (None if none did).
+        Workers match against self.view itself, which update_view() refills in place,
+        so this mustn't run at the same time as update_view()/update_regions() (e.g. from another thread).
+        """
+        with self.metrics.timed('match_batch'):
+            return self._match_many(templates, threshold, first_hit, region)
+
+    def _match_many(self, templates, threshold, first_hit, region):
+        if threshold is None:
+            threshold = self.matcher.threshold
+        templates = list(templates)
+
+        if self.match_workers == 1 or len(templates) <= 1:
+            results = {}
+            for (k, template) in templates:
+                results[k] = self.match_template(template, key = k, threshold = threshold, region = region)
+                if first_hit and results[k] >= threshold:
+                    return k
+            return None if first_hit else results
+
+        if self._match_pool is None:
+            self._match_pool = ThreadPoolExecutor(max_workers = self.match_workers or os.cpu_count())
+        view, origin = self._match_target(region)
+            # (the same array update_view() refills in place -- so don't update the view while a batch is being matched)
+        futures = {self._match_pool.submit(self._match, view, template, k, threshold, origin): k \
+                    for (k, template) in templates}
+        results = {}
+        for future in as_completed(futures):
+            k = futures[future]
+            results[k] = future.result()[0]
+            if first_hit and results[k] >= threshold:
+                for f in futures:
+                    f.cancel() # the rest of the batch isn't needed
+                return k
+        return None if first_hit else results
             
-    def save_view_as_image(self, fpath):
-        """Save the bot's current view as a file at fpath.""" 
-        im = self._arr_to_im(self.view) # flip from BGR -> RGB
-        im.save(fpath)
+    def save_view_as_image(self, fpath, wait = False):
+        """Save the bot's current view as a file at fpath (format by extension; see snapshots.write_snapshot()).
+
+        The file is written in the background by self.snapshot_writer, so it may not exist yet when this returns
+        (snapshots.read_snapshot() can read it regardless); wait = True blocks until it's written."""
+        self.snapshot_writer.save(self.view, fpath)
+        if wait:
+            self.snapshot_writer.flush()
 
 
 
     def run_macro(self, macro_label):
-        """ Run specified macro dictionary. """
+        """ Run specified macro dictionary. Returns (and keeps as self.last_macro_stats) its macro_handler.PlaybackStats. """
         print("Now performing macro: {0} ... ".format(macro_label), end = '')
         sys.stdout.flush() # make sure it prints before the macro starts running
-        macro_handler.run_macro(self.controller, self.macros[macro_label])
-        print("Done!")
+        if self.player is not None:
+            self.player.wait() # don't fight the playback thread over the controller
+        macro = self._playback_macro(macro_label)
+        start = self._macro_clock()
+        self.last_macro_stats = macro_handler.run_macro(self.controller, macro, self.scheduler, self.wait_for_checkpoint)
+        self._record_macro(macro_label, macro, self._macro_clock() - start, self.last_macro_stats)
+        if self.last_macro_stats.aborted:
+            print("Aborted! Checkpoint {0} never showed up.".format(self.last_macro_stats.aborted_at))
+        else:
+            print("Done!")
         sys.stdout.flush()
+        return self.last_macro_stats
+
+
+    def report(self, kind, **data):
+        """
+        Tell whoever's supervising the bot (self.reporter, if set) about something, e.g.
+            - 'progress': counters, such as attempts = number of seeds tried so far
+            - 'result': row = a dict of what was found for one seed
+            - 'alert': message = something a person should look at (e.g. a potentially good seed)
+        """
+        if self.reporter is not None:
+            self.reporter(kind, data)
+
+    def export_metrics(self, json_fpath = None, prometheus_fpath = None, interval = metrics.export_interval):
+        """Write self.metrics out every interval seconds (see metrics.MetricsExporter) until stop_metrics() is called
+        (or the bot is deleted, or the interpreter exits), with a final write then."""
+        self.stop_metrics()
+        self.metrics_exporter = metrics.MetricsExporter(self.metrics, json_fpath, prometheus_fpath, interval)
+        self.metrics_exporter.start()
+
+    def stop_metrics(self):
+        """Stop exporting metrics (see export_metrics()), writing them out one last time."""
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+
+    def start_macro(self, macro_label, checkpoint_wait = None):
+        """Queue a macro on the playback thread (self.player) and return right away. See macro_handler.MacroPlayer.
+        Its checkpoints are waited for with checkpoint_wait (called on the playback thread), if given."""
+        if self.player is None:
+            self.player = macro_handler.MacroPlayer(self.controller, self.scheduler)
+            self.player.start()
+        self.player.start_macro(macro_label, self._playback_macro(macro_label), checkpoint_wait)
+
+    def splice_macro(self, macro_label, checkpoint_wait = None):
+        """Cut the macro playing in the background short and play macro_label instead."""
+        if self.player is None:
+            return self.start_macro(macro_label, checkpoint_wait)
+        self.player.splice(macro_label, self._playback_macro(macro_label), checkpoint_wait)
+
+    def abort_macro(self):
+        """Stop the macro playing in the background (and drop any queued)."""
+        if self.player is not None:
+            self.player.abort()
+
+    def macro_progress(self):
+        """What's playing in the background; see macro_handler.MacroPlayer.progress()."""
+        return None if self.player is None else self.player.progress()
+
+    def run_macro_watched(self, macro_label, templates, threshold = None, region = None, watch_after = None):
+        """
+        Like run_macro(), but the macro plays in the background while frames are checked (every watch_interval seconds)
+        for any of templates ((key, template) pairs, as in match_many()).
+        If one shows up, the macro is aborted on the spot and its key is returned; otherwise returns None once it's done.
+        Either way, self.last_macro_stats has the macro's PlaybackStats.
+        Anything playback raises on the player thread (see macro_handler.MacroPlayer.wait()) is raised here.
+
+        Only frames from watch_after seconds into the macro on (or from once it's done) are checked, so templates
+        meant for the screen the macro leads to aren't looked for on the one it starts from. By default (None),
+        that's once the macro's first checkpoint has been seen (i.e. the screen has changed), or right away if it has none.
+        The macro's checkpoints are waited for as in run_macro(), but looked for here (so only this thread grabs frames).
+        """
+        print("Now performing macro: {0} ... ".format(macro_label), end = '')
+        sys.stdout.flush()
+        start = self._macro_clock()
+        scheduler = self.scheduler or macro_handler.default_scheduler
+        has_checkpoints = bool(self._playback_macro(macro_label).get('checkpoints'))
+        handoff = _CheckpointHandoff()
+        self.start_macro(macro_label, handoff.wait)
+        give_up = None # when the checkpoint being looked for times out
+        k = None
+        try:
+            while True:
+                done = self.player.wait(watch_interval)
+                checkpoint = handoff.pending()
+                if checkpoint is not None:
+                    polled = scheduler.now()
+                    if give_up is None:
+                        give_up = polled + checkpoint.get('timeout', checkpoint_timeout)
+                    seen = self._checkpoint_seen(checkpoint)
+                    if seen or polled >= give_up:
+                        handoff.resolve(seen)
+                        give_up = None
+                    else:
+                        scheduler.idle(polled + checkpoint_poll_interval)
+                if self._watching(watch_after, has_checkpoints, handoff):
+                    if region is None:
+                        self.update_view()
+                    else:
+                        self.update_regions()
+                    k = self.match_many(templates, threshold = threshold, first_hit = True, region = region)
+                if k is not None:
+                    self.abort_macro() # (before cancelling the handoff, so playback knows it was interrupted)
+                    handoff.cancel()
+                    self.player.wait()
+                    print("Aborted! Spotted {0}.".format(k))
+                    break
+                if done:
+                    if self.player.last_stats is not None and self.player.last_stats.aborted:
+                        print("Aborted! Checkpoint {0} never showed up.".format(self.player.last_stats.aborted_at))
+                    else:
+                        print("Done!")
+                    break
+        except BaseException:
+            self.abort_macro() # don't leave it running unsupervised
+            handoff.cancel()
+            raise
+        self.last_macro_stats = self.player.last_stats
+        self._record_macro(macro_label, self._playback_macro(macro_label), self._macro_clock() - start, self.last_macro_stats)
+        return k
+
+    def _watching(self, watch_after, has_checkpoints, handoff):
+        """Whether run_macro_watched() should be looking for its templates yet."""
+        if watch_after is None:
+            return handoff.passed > 0 or not has_checkpoints
+        progress = self.macro_progress()
+        return progress is None or progress[1] >= watch_after
+
+    def wait_for_checkpoint(self, checkpoint):
+        """
+        Poll frames (every checkpoint_poll_interval seconds) until checkpoint's template matches (True)
+        or its timeout passes (False). Used by run_macro() for macros with checkpoints (see macro_handler.add_checkpoint()).
+        Only checkpoint's region is captured, unless background capture is running.
+        Time is kept (and waited out) by the scheduler macros are played with, so it's simulated along with them.
+        """
+        scheduler = self.scheduler or macro_handler.default_scheduler
+        give_up = scheduler.now() + checkpoint.get('timeout', checkpoint_timeout)
+        while True:
+            polled = scheduler.now()
+            if self._checkpoint_seen(checkpoint):
+                return True
+            if polled >= give_up:
+                return False
+            scheduler.idle(polled + checkpoint_poll_interval)
+
+    def _checkpoint_seen(self, checkpoint):
+        """Whether checkpoint's template matches (its region of) a newly grabbed frame."""
+        fpath = checkpoint['template']
+        template = self._checkpoint_templates.get(fpath)
+        if template is None:
+            template = cv2.imread(fpath)
+            if template is None:
+                raise FileNotFoundError("Couldn't read checkpoint template {0}.".format(fpath))
+            self._checkpoint_templates[fpath] = template
+        threshold = checkpoint.get('threshold', self.matcher.threshold)
+        view, origin = self._grab_checkpoint_region(checkpoint.get('region'))
+        return self._match(view, template, ('checkpoint', fpath), threshold, origin)[0] >= threshold
 
-
-    
     def run(self):
         """Contains AI's routine. Can exit early with a SIG_INTERRUPT (^C)."""
         print("But I don't know what to do! run() still needs to be implemented.")
@@ -176,10 +648,76 @@ class BotView:
 
 
 
+    def _playback_macro(self, macro_label):
+        """The macro to actually play for macro_label -- coalesced the first time it's used, if coalesce_macros."""
+        if not coalesce_macros:
+            return self.macros[macro_label]
+        if macro_label not in self._playback_macros:
+            self._playback_macros[macro_label] = macro_handler.coalesce_macro(self.macros[macro_label])
+        return self._playback_macros[macro_label]
+
+    def _grab_checkpoint_region(self, region):
+        """(view, origin) of the part of the current frame in region ((x, y, w, h); None -> the whole frame)."""
+        if region is None:
+            self.update_view()
+            return self.view, (0, 0)
+        x, y, w, h = region
+        if self.capture_thread is not None: # can't grab from the backend while the capture thread is using it
+            self.update_view()
+            return self.view[y:y+h, x:x+w], (x, y)
+        bgrx = self.capture.grab_regions({'checkpoint': (x, y, w, h)})['checkpoint']
+        if self._checkpoint_view is None or self._checkpoint_view.shape[:2] != bgrx.shape[:2]:
+            self._checkpoint_view = np.empty(bgrx.shape[:2] + (3,), dtype = np.uint8)
+        cv2.cvtColor(bgrx, cv2.COLOR_BGRA2BGR, dst = self._checkpoint_view)
+        self.matcher.new_frame()
+        return self._checkpoint_view, (x, y)
+
+    def _macro_clock(self):
+        """Time as macros are played by (simulated, with a macro_handler.VirtualScheduler)."""
+        return (self.scheduler or macro_handler.default_scheduler).now()
+
+    def _record_macro(self, macro_label, macro, elapsed, stats):
+        """Add a played macro to self.metrics: how long it took against how long it was recorded to take, and its timing."""
+        scheduled = macro.get('duration', macro['times'][-1] if len(macro['times']) else 0.0)
+        self.metrics.observe('macro', elapsed, macro = macro_label)
+        self.metrics.observe('macro_scheduled', scheduled, macro = macro_label)
+        if stats is None:
+            return
+        self.metrics.observe('macro_lateness', stats.max, macro = macro_label)
+        self.metrics.count('macro_updates', stats.n_updates)
+        self.metrics.count('macro_late_updates', stats.n_late)
+        if stats.aborted or stats.interrupted:
+            self.metrics.count('macros_aborted', macro = macro_label)
+
+    def _match(self, view, template, key, threshold, origin):
+        """self.matcher.match(), timed."""
+        start = _time()
+        result = self.matcher.match(view, template, key, threshold, origin)
+        self.metrics.observe('match', _time() - start)
+        return result
+
+    def _match_target(self, region):
+        """(view, origin) to match against for region (None -> the whole view)."""
+        if region is None:
+            return self.view, (0, 0)
+        return self.region_views[region]
+
     def _arr_to_im(self, arr):
         '''Flip BGR to RGB, return as PIL Image.'''
         return Image.fromarray(arr[:,:,::-1])
 
     def __del__(self):
+        if getattr(self, 'player', None) is not None:
+            self.player.stop()
+        if getattr(self, 'metrics_exporter', None) is not None:
+            self.stop_metrics()
+        if getattr(self, '_match_pool', None) is not None:
+            self._match_pool.shutdown(wait = False)
+        if getattr(self, 'capture_thread', None) is not None:
+            self.capture_thread.stop()
+        if getattr(self, 'capture', None) is not None:
+            self.capture.close()
+        if getattr(self, 'snapshot_writer', None) is not None:
+            self.snapshot_writer.close()
         del self.controller
 
@@ -17,16 +17,14 @@ import os
 	# open macro_dd
 import bot_vision
 	# will build off BotView
-import win32api
-    # for alert window popup when a potential seed is found
 from enum import Enum
     # list out the states our bot should recognize
 import cv2 
     # used for template matching (gonna save more intense methods for more serious applications)
 import re
     # filtering templates by name
-import pickle
-    # import macro_dd
+import macro_format
+    # open macro_dd
 
 
 #############
@@ -68,7 +66,22 @@ state_to_str = {v:k for (k,v) in str_to_state.items()}
 
 max_index = 1 # index of max_value for tuple returned by cv2.minMaxLoc()
 current_check_str = "check_{0}" # for logical OR
+check_finder = re.compile(current_check_str.format(r'(\d+)')) # pulls the check number back out of a filename
 threshold = 0.90 # these are well-behaved flat images and well-defined matches, so a high threshold works
+pyramid_levels = 0
+    # set to 1 (or 2) when running the emulator at 2x (or 4x) internal resolution
+    # to match coarse-to-fine instead of at full resolution (see bot_vision.TemplateMatcher)
+
+watch_contraindicators = True
+    # while a macro plays, watch for the contraindicators of the states it likely leads to (see likely_next_states())
+    # and abandon the seed the moment one shows up, instead of waiting for the macro to finish
+watch_delay = 1.0
+    # seconds into a watched macro before contraindicators are looked for, so the next state's aren't looked for
+    # on frames from before the screen changes over to it; macros with checkpoints are watched from their first one instead
+
+state_confidence = 0.95
+    # a likely next state (see likely_next_states()) whose marker matches at least this well
+    # is taken as the current state without scoring the remaining markers
 
     # when bot's checked area matches keys, potentially good seed
 checked_areas_target = set([State.AREA_3, State.AREA_4, State.AREA_5, State.AREA_2])
@@ -78,8 +91,8 @@ debug = False
 
 
 
-# macros
-macro_dd = pickle.load(open(os.path.join(asset_dir, "macro_dd.p"), mode = 'rb'))
+# macros (each one is only loaded when first run)
+macros_dd = macro_format.open_macros(os.path.join(asset_dir, "macro_dd.p"))
 
 
 
@@ -89,10 +102,82 @@ macro_dd = pickle.load(open(os.path.join(asset_dir, "macro_dd.p"), mode = 'rb'))
 
 
 def make_alert():
+    import win32api
+        # for alert window popup when a potential seed is found
     resp = win32api.MessageBox(0, alert_str, 'Script Update', 0x00010005)
     return resp
 
 
+def likely_next_states(state, macro_label):
+    """States most likely to follow running macro_label while in state, most likely first.
+    Mirrors the transitions EvaluatorBot.act_on_current_state() drives. Empty if there's no good guess."""
+    if macro_label == 'advance_rng_seed':
+        return [State.OUTSIDE_MISSION]
+    if macro_label == 'enter_mission_and_explore_(3x_speed)':
+        return [State.MISSION_START, State.AREA_1]
+    if macro_label == 'command_mode_next_area':
+        if state == State.MISSION_START:
+            return [State.AREA_1]
+        if state in (State.AREA_1, State.AREA_2, State.AREA_3, State.AREA_4):
+            return [State(state.value + 1)] # AREA_n -> AREA_n+1
+    return []
+
+
+
+
+######################
+## TemplateBank
+######################
+
+
+class TemplateBank:
+    """Templates grouped once at startup by state and role, so per-frame checks are a straight walk.
+
+    Attributes:
+        - markers: list of (fname, template) for every state indicator.
+        - marker_states: marker fname -> State it indicates (None if the fname matches no state).
+        - markers_by_state: State -> list of (fname, template) of the markers indicating it.
+        - contraindicators: State -> list of (fname, template) that immediately rule out a seed.
+        - checks: State -> list of check groups (check_1, check_2, ...), each a list of (fname, template).
+            At least one template in every group must match for the state to look OK.
+    """
+    def __init__(self, static_templates, templates):
+        self.markers = []
+        self.marker_states = {}
+        self.markers_by_state = {}
+        self.contraindicators = {}
+        self.checks = {}
+
+        for fname in sorted(static_templates):
+            if fname.startswith(state_indicator):
+                self.markers.append((fname, templates[fname]))
+                self.marker_states[fname] = self._state_from_fname(fname)
+                self.markers_by_state.setdefault(self.marker_states[fname], []).append((fname, templates[fname]))
+
+        for (state, state_str) in state_to_str.items():
+            fnames = [k for k in sorted(static_templates) if state_str in k and state_indicator not in k]
+            self.contraindicators[state] = [(k, templates[k]) for k in fnames if contraindicator in k]
+
+            groups = {}
+            for k in fnames:
+                if contraindicator in k:
+                    continue
+                match = check_finder.search(k)
+                if match:
+                    groups.setdefault(int(match.group(1)), []).append((k, templates[k]))
+            # checks are numbered from 1 and end at the first missing number
+            self.checks[state] = []
+            check_num = 1
+            while check_num in groups:
+                self.checks[state].append(groups[check_num])
+                check_num += 1
+
+    def _state_from_fname(self, fname):
+        for (k, state) in str_to_state.items():
+            if k in fname:
+                return state
+        return None
+
 
 
 ######################
@@ -103,39 +188,47 @@ def make_alert():
 class EvaluatorBot(bot_vision.BotView):
     """Bot that can look at a window, has a vjoy device bound to it, and can perform macros.
     No built-in AI -- need to implement BotView.run() (adding methods, attributes, etc.) in derived classes."""
-    def __init__(self, window, macros, vjoy_device_num = 1):
+    def __init__(self, window, macros, vjoy_device_num = 1, capture_backend = None, controller = None):
         self.static_templates = self._generate_static_template_dict(asset_dir)
         self.templates = {k: cv2.imread(v) for (k,v) in self.static_templates.items()}
+        self.template_bank = TemplateBank(self.static_templates, self.templates)
         self.current_state = State.OUTSIDE_MISSION
         self.should_pause = False
         self.should_start_new_attempt = False
         self.checked_states = []
         self.num_tries = 0
-        super().__init__(window, macros, vjoy_device_num)
+        self.last_macro = None # used to guess the next state
+        super().__init__(window, macros, vjoy_device_num, capture_backend, controller)
+        self.matcher.pyramid_levels = pyramid_levels
     
 
     
     def update_current_state(self):
-        """Figure out current state as enumerated in State."""
+        """Figure out current state as enumerated in State.
+
+        The states likely to follow the last macro are tried first;
+        the first whose marker clears state_confidence is taken without scoring the rest.
+        Otherwise, falls back to the best-matching marker overall."""
         results = {}
-        candidates = {k:self.templates[k] for k in self.static_templates if k.startswith(state_indicator)}
-            # only looking to determine state right now
-        for (k,v) in candidates.items():
-            temp_res = cv2.matchTemplate(self.view, v, cv2.TM_CCOEFF_NORMED)
-            results[cv2.minMaxLoc(temp_res)[max_index]] = k # maxval -> fname
-
-        most_probable_state_fname = results[max(results.keys())]
-
-        for k in str_to_state.keys():
-            if k in most_probable_state_fname:
-                if debug:
-                    Image.open(self.static_templates[most_probable_state_fname]).show()
-                self.current_state = str_to_state[k]
-                print("Now in {0}.".format(self.current_state))
-                return
-        else: # shouldn't ever happen
+        for state in likely_next_states(self.current_state, self.last_macro):
+            markers = self.template_bank.markers_by_state.get(state, [])
+            results.update(self.match_many(markers, threshold = threshold))
+            most_probable_state_fname = max(results, key = results.get, default = None)
+            if most_probable_state_fname is not None and results[most_probable_state_fname] >= state_confidence:
+                break
+        else: # no confident guess -- score the remaining markers too
+            remaining = [(k, v) for (k, v) in self.template_bank.markers if k not in results]
+            results.update(self.match_many(remaining, threshold = threshold))
+            most_probable_state_fname = max(results, key = results.get)
+
+        state = self.template_bank.marker_states.get(most_probable_state_fname)
+        if state is None: # shouldn't ever happen
             raise ValueError("Did not find a matching state!\n \
-                k = {0}, most_probable_state_fname = {1}".format(k, most_probable_state_fname))
+                most_probable_state_fname = {0}".format(most_probable_state_fname))
+        if debug:
+            Image.open(self.static_templates[most_probable_state_fname]).show()
+        self.current_state = state
+        print("Now in {0}.".format(self.current_state))
     
     
     def evaluate_screen(self, threshold = threshold):
@@ -146,39 +239,24 @@ class EvaluatorBot(bot_vision.BotView):
 
         # if we're in a weird screen, can just retry
         if self.current_state == State.MACRO_MISTAKE:
+            self.metrics.count('mistakes')
             self.should_start_new_attempt = True
             return
 
-
-        # first look only at templates of interests
-        templates = {k:self.templates[k] for k in self.static_templates if state_to_str[self.current_state] in k and state_indicator not in k}
-        contraindicators = {}
-        # separate contraindicators from positive examples
-        for k in list(templates.keys()):
-            if contraindicator in k:
-                contraindicators[k] = templates.pop(k)
-        
         # first check to see if there's an immediate dealbreaker
-        for (k,v) in contraindicators.items():
-            temp_res = cv2.matchTemplate(self.view, v, cv2.TM_CCOEFF_NORMED)
-            if cv2.minMaxLoc(temp_res)[max_index] >= threshold:
-                self.should_start_new_attempt = True
-                print("Found the following contraindicator: {0}.".format(k))
-                return
+        k = self.match_many(self.template_bank.contraindicators.get(self.current_state, []), threshold = threshold, first_hit = True)
+        if k is not None:
+            self.metrics.count('rejected_seeds')
+            self.should_start_new_attempt = True
+            print("Found the following contraindicator: {0}.".format(k))
+            return
         
         # now ensure we have the positive matches we need
-        check_num = 0
-        while True:
-            check_num += 1
-            current_template_keys = [k for k in templates.keys() if current_check_str.format(check_num) in k]
-            if len(current_template_keys) == 0:
-                break # gone through all checks for given area
-            for k in current_template_keys:
-                temp_res = cv2.matchTemplate(self.view, templates.pop(k), cv2.TM_CCOEFF_NORMED)
-                if cv2.minMaxLoc(temp_res)[max_index] >= threshold:
-                    break # at least one of the mutually exclusive options is satisfied for this check_num
-            else: # python --> no need for separate loop flags
+        for (check_num, check_group) in enumerate(self.template_bank.checks.get(self.current_state, []), start = 1):
+            # at least one of the mutually exclusive options must be satisfied for this check_num
+            if self.match_many(check_group, threshold = threshold, first_hit = True) is None:
                 print("Couldn't find a positive instance of Check #{0} in {1}.".format(check_num, self.current_state))
+                self.metrics.count('rejected_seeds')
                 self.should_start_new_attempt = True # none of the mutually exclusive options were found
                 return
         
@@ -200,7 +278,8 @@ class EvaluatorBot(bot_vision.BotView):
             self.run_macro('command_mode_scroll_up')
         
 
-        self.evaluate_screen() # updates should_start_new_attempt flag
+        with self.metrics.timed('screen_evaluation'):
+            self.evaluate_screen() # updates should_start_new_attempt flag
 
 
         # should reset?
@@ -228,12 +307,34 @@ class EvaluatorBot(bot_vision.BotView):
     
 
     def run_macro(self, macro_label):
-        """ Run specified macro dictionary. """
-        super().run_macro(macro_label)
+        """ Run specified macro dictionary.
+        If watch_contraindicators, it's aborted as soon as a contraindicator shows up, and the seed is advanced. """
+        watched = []
+        if watch_contraindicators:
+            for state in likely_next_states(self.current_state, macro_label):
+                watched.extend(self.template_bank.contraindicators.get(state, []))
+        if watched:
+            has_checkpoints = bool(self.macros[macro_label].get('checkpoints'))
+            k = self.run_macro_watched(macro_label, watched, threshold = threshold,
+                watch_after = None if has_checkpoints else watch_delay)
+        else:
+            k = None
+            super().run_macro(macro_label)
+        self.last_macro = macro_label
+        if k is not None: # bad seed -- no need to look any closer
+            self.metrics.count('rejected_seeds')
+            self.metrics.count('watchdog_aborts')
+            print("Found the following contraindicator: {0}.".format(k))
+            self.checked_states = []
+            self.should_start_new_attempt = False
+            self.run_macro('advance_rng_seed')
+            return
         # for fun
         if macro_label == 'advance_rng_seed':
             self.num_tries += 1
+            self.metrics.count('attempts')
             print("\nStarting Attempt #{0}...".format(self.num_tries))
+            self.report('progress', attempts = self.num_tries)
 
     
     def run(self):
@@ -245,9 +346,13 @@ class EvaluatorBot(bot_vision.BotView):
             try: # core loop
                 while not self.should_pause:
                     self.update_view()
-                    self.update_current_state()
+                    with self.metrics.timed('state_detection'):
+                        self.update_current_state()
                     self.act_on_current_state()
                 # if out of loop, should pause and notify user
+                self.report('alert', message = "Potentially good seed after {0} attempts.".format(self.num_tries))
+                if not self.interactive: # leave the game on this seed for whoever gets the alert
+                    return
                 sig = make_alert()
                 if sig == SIG_RETRY:
                     self.should_pause = False
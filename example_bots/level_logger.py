@@ -1,14 +1,16 @@
 import bot_vision as bv # build LevelLogger of BotView
 import os # open/save files
 import re # filtering files by name
-import pickle # import macro_dd
+import macro_format # open macro_dd
 import numpy as np
 from PIL import Image
 import sys # flush stdout
 
-import csv # log results to file
+import results_store # log results to file
 
 import cv2 # template matching (can't just compare directly because of a few animated elements)
+import template_store # fingerprint index of seen screens
+import snapshots # history screens that couldn't be written
 
 mistake_threshold = 0.99
 threshold = 0.999
@@ -30,7 +32,8 @@ max_index = 1 # index of max_value for tuple returned by cv2.minMaxLoc()
 window_class_title = 'PPSSPPWnd'
 
 key_fmt = 'area_{0}' # to be used in logging
-history_file_fmt = '{0}-{1}.bmp' # {0} = key_fmt, {1} = index_num of screenshot
+history_file_fmt = '{0}-{1}.png' # {0} = key_fmt, {1} = index_num of screenshot; '.npy' saves fastest (see snapshots.write_snapshot)
+	# (existing .bmp history files are still read)
 
 index_finder = re.compile(r'-(\d+)\.')
 marker_indicator = 'marker'
@@ -39,9 +42,17 @@ marker_dir = 'markers'
 
 mistake_indicator = 'macro_mistake'
 
-csv_fp = os.path.join(hist_dir, 'results.csv')
+results_fp = os.path.join(hist_dir, 'results.csv') # '.db' logs to SQLite instead (see results_store.open_sink)
+fingerprint_fn = 'fingerprints.txt' # kept in hist_dir (see template_store.FingerprintIndex)
+template_budget = 512 * 2**20 # bytes of history templates to keep decoded in memory (see template_store.TemplateStore)
+match_batch_size = 16 # templates decoded and matched at a time when checking the whole history
+verify_new_screens = True
+	# a screen none of the nearest fingerprints match is checked against the whole history before it's saved as new,
+	# so a screen whose fingerprint has drifted (e.g. by animations) never gets a second index;
+	# False skips that (much faster once the history is large: every template gets decoded and matched)
+	# at the risk of doing so. Always done when debug is set
 
-macros_dd = pickle.load(open(os.path.join(hist_dir, "macro_dd.p"), mode = 'rb'))
+macros_dd = macro_format.open_macros(os.path.join(hist_dir, "macro_dd.p")) # each macro only loaded when first run
 
 class LevelLogger(bv.BotView):
 	"""
@@ -50,10 +61,11 @@ class LevelLogger(bv.BotView):
 	explore the level in order to expose all enemy locations.
 	It will compare the current screens with screen it's seen before
 	(and will assign the screen a new index if it's new).
-	It will log the combinations of screens it sees into a CSV.
+	It will log the combinations of screens it sees into a CSV (or SQLite database).
 	Will keep going until it receives a KeyboardInterrupt.
 	"""
-	def __init__(self, window, macros, threshold = threshold, vjoy_device_num = 1, hist_dir = hist_dir):
+	def __init__(self, window, macros, threshold = threshold, vjoy_device_num = 1, hist_dir = hist_dir,
+			capture_backend = None, controller = None):
 		self.threshold = threshold
 		# self.output_dir = output_dir
 		self.hist_dir = hist_dir
@@ -62,11 +74,13 @@ class LevelLogger(bv.BotView):
 		self.valid_keyset = set(self.area_keys)
 		self.next_area_values = self.init_next_area_values() # "Area X" : (what would be the next unseen area's index)
 		self.seen_areas = {}
+		self.results = results_store.open_sink(results_fp, self.area_keys) # buffered; written a batch at a time
 		self.templates = self.init_templates()
+		self.fingerprints = self.init_fingerprints()
 		# self.mistake_templates = self.init_mistake_templates()
 		self.marker_templates = self.init_verification_dict()
 		self.made_mistake = False
-		super().__init__(window, macros, vjoy_device_num)
+		super().__init__(window, macros, vjoy_device_num, capture_backend, controller)
 
 	def refresh(self):
 		""" Prepare for next iteration. """
@@ -91,11 +105,17 @@ class LevelLogger(bv.BotView):
 		It determines which template to use by seeing whether macro_label is in the template's fpath
 		according to the format described in marker_fmt."""
 		super().run_macro(macro_label)
+		if self.last_macro_stats.aborted: # a checkpoint never showed up, so it's already off track
+			self.made_mistake = True
+			self.metrics.count('mistakes')
+			return
 		# for fun
 		# if macro_label == 'advance_rng_seed':
 		if macro_label == 'enter_briefing':
 			self.num_iter += 1
+			self.metrics.count('attempts')
 			print("\nStarting Iteration #{0}...".format(self.num_iter))
+			self.report('progress', attempts = self.num_iter)
 		if verify:
 			key = marker_fmt.format(macro_label)
 			try:
@@ -103,8 +123,9 @@ class LevelLogger(bv.BotView):
 				print("Verifying macro results ... ", end = '')
 				sys.stdout.flush()
 				template = self.marker_templates[key]
-				if not self.is_matching_template(template, threshold = mistake_threshold):
+				if not self.is_matching_template(template, threshold = mistake_threshold, key = key):
 					self.made_mistake = True
+					self.metrics.count('mistakes')
 					return
 				else:
 					print("Looks OK to me!")
@@ -115,40 +136,39 @@ class LevelLogger(bv.BotView):
 
 
 	def init_templates(self):
-		"""Load in templates for bot to use."""
-		templates = {}
+		"""Register templates for bot to use. They're only decoded when needed (see template_store.TemplateStore)."""
+		templates = template_store.TemplateStore(template_budget)
 			# get list of filepaths to open with cv2
 		hist_files = [os.path.join(self.hist_dir, fn) for fn in os.listdir(self.hist_dir)]
-			# load files into memory
 		for key in self.valid_keyset:
-			cur_fns = [fn for fn in hist_files if key in fn]
-			templates[key] = {fn: cv2.imread(fn) for fn in cur_fns}
-				# can use key to get to dict of just the relevant templates
-				# within each dict, have fn -> cv2 template
+			for fn in [fn for fn in hist_files if key in fn]:
+				templates.add(key, fn)
+					# can use templates.fpaths(key) to get just the relevant templates
+					# and templates[fn] to get the cv2 template
 		return templates
 
 
+	def init_fingerprints(self):
+		"""Index the loaded templates by fingerprint (see template_store.FingerprintIndex)."""
+		index = template_store.FingerprintIndex(os.path.join(self.hist_dir, fingerprint_fn))
+		for key in self.valid_keyset:
+			for fn in self.templates.fpaths(key):
+				index.add(key, fn, self.templates[fn] if index.needs_image(fn) else None) # only decode if not hashed yet
+		return index
+
+
 	# def init_mistake_templates(self):
 	# 	mistake_files = [os.path.join(self.hist_dir, fn) for fn in os.listdir(self.hist_dir) if mistake_indicator in fn]
 	# 	return {fn: cv2.imread(fn) for fn in mistake_files}
 
-	def log_to_csv(self):
-		""" Log what the bot has seen into the filepath indicated by csv_fp. """
-		while True:
-			try:
-				with open(csv_fp, mode = 'x', newline = '') as f:
-					writer = csv.DictWriter(f, fieldnames = self.area_keys)
-					writer.writeheader()
-					writer.writerow(self.seen_areas)
-				break
-			except PermissionError: # CSV is currently open
-				input("Output CSV currently open! Close and press Enter to retry.\n")
-				continue
-			except FileExistsError: # don't (re)write header
-				with open(csv_fp, mode = 'a', newline = '') as f:
-					writer = csv.DictWriter(f, fieldnames = self.area_keys)
-					writer.writerow(self.seen_areas)
-				break
+	def log_results(self):
+		""" Log what the bot has seen into the results file indicated by results_fp
+		(or, if it's supervised, hand it to whoever's collecting results -- see orchestrator). """
+		if self.reporter is None:
+			self.results.interactive = self.interactive # (don't ask anyone to close a locked CSV if there's no one to ask)
+			self.results.log(self.seen_areas)
+		else:
+			self.report('result', row = dict(self.seen_areas))
 
 
 
@@ -160,18 +180,18 @@ class LevelLogger(bv.BotView):
 			d[key] = len([fn for fn in os.listdir(self.hist_dir) if key in fn])
 		return d
 
-	def is_matching_template(self, template, threshold = None):
-		""" Sees if the maximum value in a cv2.matchTemplate is at least threshold. Default is self.threshold"""
+	def is_matching_template(self, template, threshold = None, key = None):
+		""" Sees if the maximum value in a cv2.matchTemplate is at least threshold. Default is self.threshold
+		key identifies template so its last match location can be checked first (see bv.TemplateMatcher)."""
 		if threshold is None:
 			threshold = self.threshold # can't seem to make this default in function definition
-		temp_res = cv2.matchTemplate(self.view, template, cv2.TM_CCOEFF_NORMED)
-		max_val = cv2.minMaxLoc(temp_res)[max_index]
+		max_val = self.match_template(template, key = key, threshold = threshold)
 		return max_val >= threshold
 
 	def match_templates(self, templates):
 		""" Returns a dictionary of (max value of cv2.matchTemplate(self.view, template):fn) for each template in templates. """
-		return {cv2.minMaxLoc(cv2.matchTemplate(self.view, template, cv2.TM_CCOEFF_NORMED))[max_index]:fn \
-						for (fn, template) in templates.items()}
+		results = self.match_many(templates.items(), threshold = self.threshold) # matched in parallel
+		return {max_val:fn for (fn, max_val) in results.items()}
 
 	def evaluate_screen(self, key_str):
 		"""
@@ -192,9 +212,15 @@ class LevelLogger(bv.BotView):
 		# 		index = index_finder.findall(fn)[0] # get index from filename
 		# 		self.seen_areas[key_str] = index
 		# 		return
-		max_vals_dict = self.match_templates(self.templates[key_str])
-
+		# only screens with close enough fingerprints can match -- anything else is taken to be new
+		candidates = self.fingerprints.candidates(key_str, self.view, max_distance = template_store.max_distance)
+		max_vals_dict = self.match_templates({fn:self.templates[fn] for fn in candidates})
 		max_val = max(max_vals_dict.keys(), default = -1) # default only if empty dictionary
+		if max_val < self.threshold and (verify_new_screens or debug): # make sure it's really new before saving it as such
+			rest = [fn for fn in self.templates.fpaths(key_str) if fn not in candidates]
+			for i in range(0, len(rest), match_batch_size): # a batch at a time, so it never all has to be decoded at once
+				max_vals_dict.update(self.match_templates({fn:self.templates[fn] for fn in rest[i:i+match_batch_size]}))
+			max_val = max(max_vals_dict.keys(), default = -1)
 		# debug but slow...
 		if debug:
 			filtered_dict = {k:v for (k,v) in max_vals_dict.items() if k == max_val}
@@ -214,9 +240,16 @@ class LevelLogger(bv.BotView):
 			cur_max_index = self.next_area_values[key_str]
 			fp_newimg = os.path.join(self.hist_dir, history_file_fmt.format(key_str, cur_max_index))
 			print("New instance. Saving to {0}.".format(fp_newimg))
-			self.save_view_as_image(fp_newimg) # save image to history for future runs (and visual inspection)
+			try:
+				self.save_view_as_image(fp_newimg) # save image to history for future runs (and visual inspection)
+					# (written in the background; until then, reading fp_newimg back gets the queued copy)
+			except snapshots.SnapshotError as e: # an earlier screen couldn't be written (it's still kept in memory)
+				print("WARNING: {0}".format(e))
+				self.metrics.count('snapshot_errors', len(e.fpaths))
 				# save current view as new template directly (without opening newly saved image)
-			self.templates[key_str][fp_newimg] = self.view # already in BGR order, can add directly to templates
+			self.templates.add(key_str, fp_newimg, self.view.copy()) # already in BGR order, can add directly to templates
+				# (copied since update_view() refills self.view in place)
+			self.fingerprints.add(key_str, fp_newimg, self.view)
 			self.seen_areas[key_str] = cur_max_index
 			self.next_area_values[key_str] += 1 # update index
 
@@ -243,16 +276,23 @@ class LevelLogger(bv.BotView):
 							print("Whoops! Macro didn't execute properly. Retrying from start...")
 							break
 						self.update_view()
-						self.evaluate_screen(key_str)
+						with self.metrics.timed('screen_evaluation'):
+							self.evaluate_screen(key_str)
 
 					# out of exploration loop
 					if self.made_mistake:
+						self.metrics.count('retries')
 						continue # don't log (and don't advance rng)
 						
-					self.log_to_csv() # log to file if there wasn't a mistake
+					self.log_results() # log to file if there wasn't a mistake
 					self.run_macro('advance_rng_seed', verify = False)
 					# ...and on we go!
 			except KeyboardInterrupt:
+				print("History templates: {0}".format(self.templates.summary()))
+				print("Snapshots: {0}".format(self.snapshot_writer.summary()))
+				for (fpath, e) in self.snapshot_writer.errors:
+					print("Couldn't write {0}: {1}".format(fpath, e))
+				self.results.flush() # so the results file is up to date while paused
 				input("{0}{1}".format("Send another KeyboardInterrupt to exit the program.\n",
 					"Otherwise, press Enter to continue.\n"))
 				continue
\ No newline at end of file
@@ -1,6 +1,6 @@
 import bot_vision as bv # SeedFinder will inherit from BotView
 import os
-import pickle
+import macro_format
 
 import cv2 # template matching
 
@@ -10,34 +10,40 @@ asset_dir = 'finder'
 target_fn = 'good_seed_indicator-min.png'
 macro_fn = 'macro_dd-min.p'
 
-with open(os.path.join(asset_dir, macro_fn), mode = 'rb') as f:
-	macros_dd = pickle.load(f)
+macros_dd = macro_format.open_macros(os.path.join(asset_dir, macro_fn)) # each macro only loaded when first run
 
 window_class_title = 'PPSSPPWnd'
 threshold = 0.99 # 0.95 works for the lvet variant
+target_region = None
+	# (x, y, w, h) of the part of the window the target can show up in
+	# if set, only that part of the window is captured and searched; None -> the whole window
 max_index = 1
 
 
 class SeedFinder(bv.BotView):
 	'''Incredibly simple bot meant to look for one indicator.'''
-	def __init__(self, window, macros, threshold = threshold, vjoydevice_num = 1):
+	def __init__(self, window, macros, threshold = threshold, vjoydevice_num = 1, capture_backend = None, controller = None):
 		self.num_iter = 0
 		self.threshold = threshold
 		self.target_template = cv2.imread(os.path.join(asset_dir, target_fn)) # just one template
-		super().__init__(window, macros, vjoydevice_num)
+		super().__init__(window, macros, vjoydevice_num, capture_backend, controller)
+		if target_region is not None:
+			self.regions['target'] = target_region
 
 
 	def run_macro(self, macro_label):
 		super().run_macro(macro_label)
 		if macro_label == 'enter_briefing':
 			self.num_iter += 1
+			self.metrics.count('attempts')
 			print("\nStarting Iteration #{0}...".format(self.num_iter))
+			self.report('progress', attempts = self.num_iter)
 
 	def find_target(self):
-		temp_res = cv2.matchTemplate(self.view, self.target_template, cv2.TM_CCOEFF_NORMED)
-		max_val = cv2.minMaxLoc(temp_res)[max_index]
+		region = 'target' if 'target' in self.regions else None
+		max_val = self.match_template(self.target_template, key = target_fn, threshold = self.threshold, region = region)
 		print("Current view matches target_template with max_val = {0}".format(max_val))
-		return cv2.minMaxLoc(temp_res)[max_index] >= threshold
+		return max_val >= self.threshold
 
 	def run(self):
 			while True:
@@ -45,8 +51,16 @@ class SeedFinder(bv.BotView):
 				self.run_macro('enter_briefing')
 				self.run_macro('save_state_in_briefing')
 				self.run_macro('enter_mission')
-				self.update_view()
-				if self.find_target():
+				if 'target' in self.regions:
+					self.update_regions() # only need to look where the target can be
+				else:
+					self.update_view()
+				with self.metrics.timed('target_search'):
+					found = self.find_target()
+				if found:
+					self.report('alert', message = "Desired template found after {0} attempts.".format(self.num_iter))
+					if not self.interactive: # stay in this seed's briefing for whoever gets the alert
+						break
 					resp = input("{0}{1}{2}".format("Desired template found! Confirm that the seed is desirable.\n",
 									"If the seed is desirable, type 'y' and I'll try to re-enter on the same seed.\n",
 									"Otherwise, type nothing and I'll keep trying other RNG seeds."))
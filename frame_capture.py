@@ -0,0 +1,430 @@
+# coding: utf-8
+
+# Frame sources for BotView.
+# Every backend hands back frames in the same layout as a 32-bit Windows bitmap:
+# an (h, w, 4) uint8 np.ndarray of BGRX pixels (the X byte is meaningless).
+#
+# - Win32Capture keeps a PrintWindow capture session open between frames
+#   (window handle, device contexts and bitmap are only rebuilt when needed).
+# - ReplayCapture plays back frames from a directory of images or a video file,
+#   so bots can be run and benchmarked without Windows or an emulator.
+# - ScriptedCapture does the same, but steps through the frames as a (fake) controller receives input (see simulation).
+#
+# CaptureThread keeps pulling frames from any backend in the background (e.g. while a macro plays),
+# converting them to BGR into a ring of preallocated frames.
+
+
+
+import os
+import threading
+from time import perf_counter as _time
+from ctypes import c_void_p
+import numpy as np
+import cv2
+    # reading replay frames
+
+
+image_exts = ('.bmp', '.png', '.jpg', '.jpeg') # what ReplayCapture picks up from a directory
+SRCCOPY = 0x00CC0020 # BitBlt raster operation (from wingdi.h)
+
+
+
+class CaptureBackend:
+    """Source of frames for a BotView. Subclasses implement grab()."""
+    def grab(self):
+        """Return the current frame as an (h, w, 4) uint8 np.ndarray of BGRX pixels.
+        The array is owned by the backend and may be overwritten by the next grab()."""
+        raise NotImplementedError
+
+    def grab_regions(self, regions):
+        """
+        Return only parts of the current frame.
+        Inputs:
+            - regions: dict of name -> (x, y, w, h) rectangles, in frame coordinates.
+        Returns:
+            dict of name -> (h, w, 4) uint8 np.ndarray of BGRX pixels (again, possibly reused by the next call).
+        By default this grabs the full frame and slices it; backends that can copy less override it.
+        """
+        frame = self.grab()
+        return {name: frame[y:y+h, x:x+w] for (name, (x, y, w, h)) in regions.items()}
+
+    def close(self):
+        """Release whatever the backend holds on to."""
+        pass
+
+    def __del__(self):
+        self.close()
+
+
+
+class Win32Capture(CaptureBackend):
+    """
+    Take screenshots of a window, even if it's obscured by other windows or is off-screen.
+    NOTE: Target window must *not* be minimized.
+
+    Unlike a one-off screenshot, the window handle and device contexts are kept between frames,
+    and the bitmap (and the pixel buffer it's read into) is only reallocated when the window's size changes.
+    Inputs:
+        - class_title: the name of the window's class title (*not* the window title).
+        - just_display: whether to grab the client window (True); or also grab the menu, window title, etc (False).
+        - pid, title: to pick one of several windows with class_title (e.g. when running several emulators):
+            the one owned by process pid, and/or whose title contains title (see find_window()).
+    """
+    def __init__(self, class_title, just_display = True, pid = None, title = None):
+        import win32gui
+        import win32ui
+        from ctypes import windll
+            # only importable on Windows
+        self._win32gui, self._win32ui, self._windll = win32gui, win32ui, windll
+        self.class_title = class_title
+        self.just_display = just_display
+        self.pid = pid
+        self.title = title
+        self.hwnd = None
+        self._hwndDC = self._mfcDC = self._saveDC = self._bitmap = None
+        self._buf = None
+        self._region_bufs = {} # region name -> (DC, bitmap, buffer)
+        self._last_regions = {} # region name -> buffer (survives close())
+
+    def grab(self):
+        if not self._render():
+            return self._buf
+
+        # dump the bitmap straight into our buffer (no intermediate bytes object)
+        self._windll.gdi32.GetBitmapBits(self._bitmap.GetHandle(), self._buf.nbytes, self._buf.ctypes.data_as(c_void_p))
+        return self._buf
+
+    def grab_regions(self, regions):
+        """Like grab(), but only copies the given (x, y, w, h) regions out of the rendered window.
+        (PrintWindow still renders the whole window -- it's the only way to see obscured windows.)"""
+        if not self._render(): # hand back what we had last time
+            return {name: self._last_regions[name] for name in regions if name in self._last_regions}
+        out = {}
+        for (name, (x, y, w, h)) in regions.items():
+            regionDC, bitmap, buf = self._region_buffer(name, w, h)
+            regionDC.BitBlt((0, 0), (w, h), self._saveDC, (x, y), SRCCOPY) # copy just this rectangle
+            self._windll.gdi32.GetBitmapBits(bitmap.GetHandle(), buf.nbytes, buf.ctypes.data_as(c_void_p))
+            out[name] = buf
+        self._last_regions.update(out)
+        return out
+
+    def _render(self):
+        """PrintWindow into our bitmap. Returns whether it worked."""
+        if self.hwnd is None:
+            self._open()
+
+        # get coords
+        if self.just_display:
+            left, top, right, bot = self._win32gui.GetClientRect(self.hwnd)
+        else:
+            left, top, right, bot = self._win32gui.GetWindowRect(self.hwnd)
+        w, h = right - left, bot - top
+        if self._buf is None or self._buf.shape[:2] != (h, w):
+            self._resize(w, h)
+
+        # Change just_display depending on whether you want the whole window (0)
+        # or just the client area, i.e. no top menu, title bar, etc. (1)
+        result = self._windll.user32.PrintWindow(self.hwnd, self._saveDC.GetSafeHdc(), int(self.just_display))
+        if not result: # window probably went away (e.g. emulator crash) -- find it again next time
+            self.close()
+        return bool(result)
+
+    def _region_buffer(self, name, w, h):
+        """(DC, bitmap, buffer) to copy region name into, (re)made if it's missing or the wrong size."""
+        bufs = self._region_bufs.get(name)
+        if bufs is None or bufs[2].shape[:2] != (h, w):
+            if bufs is not None:
+                self._win32gui.DeleteObject(bufs[1].GetHandle())
+                bufs[0].DeleteDC()
+            regionDC = self._mfcDC.CreateCompatibleDC()
+            bitmap = self._win32ui.CreateBitmap()
+            bitmap.CreateCompatibleBitmap(self._mfcDC, w, h)
+            regionDC.SelectObject(bitmap)
+            bufs = self._region_bufs[name] = (regionDC, bitmap, np.empty((h, w, 4), dtype = np.uint8))
+        return bufs
+
+    def close(self):
+        if getattr(self, 'hwnd', None) is None:
+            return
+        # remove our objects to avoid a memory leak
+        for (regionDC, bitmap, _) in self._region_bufs.values():
+            self._win32gui.DeleteObject(bitmap.GetHandle())
+            regionDC.DeleteDC()
+        self._region_bufs = {}
+        if self._bitmap is not None:
+            self._win32gui.DeleteObject(self._bitmap.GetHandle())
+        self._saveDC.DeleteDC()
+        self._mfcDC.DeleteDC()
+        self._win32gui.ReleaseDC(self.hwnd, self._hwndDC)
+        self.hwnd = None
+        self._hwndDC = self._mfcDC = self._saveDC = self._bitmap = None
+
+    def _open(self):
+        if self.pid is None and self.title is None:
+            # class titles (first argument) don't usually change, unlike window titles (the second argument)
+            hwnd = self._win32gui.FindWindow(self.class_title, None)
+        else:
+            hwnd = find_window(self.class_title, self.pid, self.title)
+        if not hwnd:
+            raise RuntimeError("Couldn't find a window with class title {0} (pid {1}, title {2!r}).".format(
+                self.class_title, self.pid, self.title))
+        self.hwnd = hwnd
+        self._hwndDC = self._win32gui.GetWindowDC(hwnd) # get the device context ("DC") for window
+        self._mfcDC = self._win32ui.CreateDCFromHandle(self._hwndDC)
+        self._saveDC = self._mfcDC.CreateCompatibleDC()
+            # making a new context to be a bitmap container
+            # should be compatible with the source of the bitmap (hence mfcDC)
+        self._bitmap = None
+        self._buf = None # force a new bitmap for the new DCs
+
+    def _resize(self, w, h):
+        if self._bitmap is not None:
+            self._win32gui.DeleteObject(self._bitmap.GetHandle())
+        self._bitmap = self._win32ui.CreateBitmap()
+        self._bitmap.CreateCompatibleBitmap(self._mfcDC, w, h)
+        self._saveDC.SelectObject(self._bitmap) # attach context to screenshot
+        self._buf = np.empty((h, w, 4), dtype = np.uint8)
+
+
+
+def find_window(class_title, pid = None, title = None):
+    """
+    Handle of a top-level window with class title class_title that belongs to process pid (if given)
+    and whose window title contains title (if given); 0 if there's none. Windows-only.
+    """
+    import win32gui
+    import win32process
+    found = []
+    def check(hwnd, _):
+        if win32gui.GetClassName(hwnd) != class_title:
+            return True
+        if title is not None and title not in win32gui.GetWindowText(hwnd):
+            return True
+        if pid is not None and win32process.GetWindowThreadProcessId(hwnd)[1] != pid:
+            return True
+        found.append(hwnd)
+        return False # stop enumerating
+    try:
+        win32gui.EnumWindows(check, None)
+    except win32gui.error: # (raised when the callback stops the enumeration early)
+        pass
+    return found[0] if found else 0
+
+
+
+class ReplayCapture(CaptureBackend):
+    """
+    Play back recorded frames: every grab() returns the next frame.
+    Inputs:
+        - source: a directory of images (read in filename order) or a video file cv2 can open.
+        - loop: whether to start over after the last frame (otherwise the last frame is repeated).
+    """
+    def __init__(self, source, loop = True):
+        self.source = source
+        self.loop = loop
+        self.index = -1 # index of the frame last returned
+        self._buf = None
+        self._video = None
+        if os.path.isdir(source):
+            self.fpaths = [os.path.join(source, fn) for fn in sorted(os.listdir(source)) if fn.lower().endswith(image_exts)]
+            if not self.fpaths:
+                raise ValueError("No images found in {0}.".format(source))
+        else:
+            self.fpaths = None
+            self._video = cv2.VideoCapture(source)
+            if not self._video.isOpened():
+                raise ValueError("Couldn't open {0} as a video.".format(source))
+
+    def grab(self):
+        frame = self._next_frame()
+        if frame is None: # ran out of frames
+            return self._buf
+        if self._buf is None or self._buf.shape[:2] != frame.shape[:2]:
+            self._buf = np.empty(frame.shape[:2] + (4,), dtype = np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst = self._buf)
+        return self._buf
+
+    def close(self):
+        if getattr(self, '_video', None) is not None:
+            self._video.release()
+            self._video = None
+
+    def _next_frame(self):
+        """Next BGR frame, or None if there are no more (and loop is False)."""
+        if self.fpaths is not None:
+            if self.index + 1 >= len(self.fpaths):
+                if not self.loop:
+                    return None
+                self.index = -1
+            self.index += 1
+            return cv2.imread(self.fpaths[self.index])
+
+        ok, frame = self._video.read()
+        if not ok and self.loop:
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.index = -1
+            ok, frame = self._video.read()
+        if not ok:
+            return None
+        self.index += 1
+        return frame
+
+
+
+
+class ScriptedCapture(ReplayCapture):
+    """
+    Play back recorded frames in step with the input a (fake) controller receives, rather than one per grab():
+    grab() shows frame script[n] (frame n if there's no script), where n is how many advance_on events
+    on_input() has seen -- 'reset' steps once per macro played, 'update' once per controller update.
+    'idle' events (a bot waiting for the screen to change, e.g. for a macro checkpoint) also step, if advance_on_idle,
+    so a script can show a few frames of loading before the one a checkpoint is waiting for.
+    Register on_input as a listener of a simulation.FakeVJoyDevice and a macro_handler.VirtualScheduler
+    (or see simulation.simulate()).
+    Inputs:
+        - source: a directory of images (read in filename order) or a video file cv2 can open.
+        - script: list of frame indices to show at each step (the last one is held once it runs out).
+        - advance_on: controller event that moves to the next step.
+        - advance_on_idle: whether 'idle' events move to the next step too.
+        - loop: whether frame indices past the last frame wrap around (otherwise the last frame is repeated).
+    Frames are decoded once, as they're first needed, and kept (so keep sources short).
+    """
+    def __init__(self, source, script = None, advance_on = 'reset', loop = True, advance_on_idle = True):
+        super().__init__(source, loop = False) # frames are read through once, in order, into self._frames
+        self.wrap = loop
+        self.script = script
+        self.advance_on = advance_on
+        self.advance_on_idle = advance_on_idle
+        self.step = 0
+        self._frames = [] # BGRX frames read so far
+        self._exhausted = False
+
+    def on_input(self, event, t, state):
+        """Controller (and scheduler) listener: advance a step on every advance_on (or 'idle') event."""
+        if event == self.advance_on or (event == 'idle' and self.advance_on_idle):
+            self.step += 1
+
+    def grab(self):
+        if self.script is None:
+            i = self.step
+        else:
+            i = self.script[min(self.step, len(self.script) - 1)]
+        return self._frame(i)
+
+    def _frame(self, i):
+        while len(self._frames) <= i and not self._exhausted:
+            frame = self._next_frame()
+            if frame is None:
+                self._exhausted = True
+                break
+            self._frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA))
+        if not self._frames:
+            raise ValueError("No frames could be read from {0}.".format(self.source))
+        if i >= len(self._frames):
+            i = i % len(self._frames) if self.wrap else len(self._frames) - 1
+        return self._frames[i]
+
+
+
+class CaptureThread(threading.Thread):
+    """
+    Keeps grabbing frames from backend into a bounded ring of n_frames preallocated BGR frames,
+    waiting interval seconds between the starts of consecutive grabs (0 -> as fast as possible).
+
+    Each frame is stamped with the time (time.perf_counter()) its grab *started*,
+    so a frame stamped after T shows the window as it was after T.
+    Frames handed out are copies (into out, if given and the right shape),
+    since the ring keeps getting overwritten.
+    """
+    def __init__(self, backend, n_frames = 8, interval = 0.0):
+        super().__init__(daemon = True)
+        self.backend = backend
+        self.interval = interval
+        self.error = None # exception that stopped the thread, if any
+        self._frames = [None] * n_frames
+        self._times = [None] * n_frames
+        self._count = 0 # total frames captured so far
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        n = len(self._frames)
+        next_start = _time()
+        while not self._stop_event.is_set():
+            start = _time()
+            try:
+                bgrx = self.backend.grab()
+            except Exception as e:
+                self.error = e
+                break
+            if bgrx is not None:
+                with self._cond: # readers never see a half-written frame
+                    slot = self._count % n
+                    if self._frames[slot] is None or self._frames[slot].shape[:2] != bgrx.shape[:2]:
+                        self._frames[slot] = np.empty(bgrx.shape[:2] + (3,), dtype = np.uint8)
+                    cv2.cvtColor(bgrx, cv2.COLOR_BGRA2BGR, dst = self._frames[slot])
+                    self._times[slot] = start
+                    self._count += 1
+                    self._cond.notify_all()
+            if self.interval:
+                next_start += self.interval
+                self._stop_event.wait(max(next_start - _time(), 0))
+        with self._cond:
+            self._cond.notify_all() # wake up anyone still waiting on a frame
+
+    def stop(self, timeout = None):
+        """Stop capturing and wait for the thread to finish."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def latest(self, out = None):
+        """(timestamp, frame) of the newest frame, or (None, None) if nothing has been captured yet."""
+        with self._cond:
+            if self._count == 0:
+                return (None, None)
+            slot = (self._count - 1) % len(self._frames)
+            return (self._times[slot], _copy_frame(self._frames[slot], out))
+
+    def first_after(self, t, timeout = None, out = None):
+        """
+        (timestamp, frame) of the oldest frame still in the ring whose grab started after t,
+        waiting up to timeout seconds (None -> forever) for one to arrive.
+        Returns (None, None) on timeout or if the thread stopped.
+        """
+        deadline = None if timeout is None else _time() + timeout
+        with self._cond:
+            while True:
+                slot = self._first_slot_after(t)
+                if slot is not None:
+                    return (self._times[slot], _copy_frame(self._frames[slot], out))
+                if not self.is_alive():
+                    return (None, None)
+                remaining = None if deadline is None else deadline - _time()
+                if remaining is not None and remaining <= 0:
+                    return (None, None)
+                self._cond.wait(remaining)
+
+    def recent(self, n):
+        """List of (timestamp, frame) for (up to) the n newest frames, oldest first."""
+        with self._cond:
+            n = min(n, self._count, len(self._frames))
+            slots = [(self._count - i) % len(self._frames) for i in range(n, 0, -1)]
+            return [(self._times[slot], self._frames[slot].copy()) for slot in slots]
+
+    def _first_slot_after(self, t):
+        n = min(self._count, len(self._frames))
+        for i in range(n, 0, -1): # oldest to newest
+            slot = (self._count - i) % len(self._frames)
+            if self._times[slot] > t:
+                return slot
+        return None
+
+
+
+def _copy_frame(frame, out = None):
+    """Copy frame into out if it's the right shape, otherwise into a new array."""
+    if out is not None and out.shape == frame.shape:
+        np.copyto(out, frame)
+        return out
+    return frame.copy()
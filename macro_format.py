@@ -0,0 +1,372 @@
+# coding: utf-8
+
+# Compact, columnar storage for macros.
+#
+# Macros used to be saved as pickled dicts of lists of pyvjoy._sdk._JOYSTICK_POSITION_V2 ctypes structs
+# (plus a list of float times), which is large, slow to unpickle and needs pyvjoy (i.e. Windows) to load at all.
+# Here, each macro is a single NumPy structured array with one column for the times, one for the buttons
+# and one per axis, and a whole macro dictionary is saved as an uncompressed .npz file (no pickling involved).
+#
+# MacroLibrary opens such a file lazily: a macro is only read (and turned back into vJoy structs)
+# the first time it's asked for by label. open_macros() picks the right loader for a bot's macro file.
+#
+# To convert an existing macro_dd pickle:
+#     python macro_format.py macro_dd.p macro_dd.npz
+#
+# Recordings in progress are written to a separate, append-only stream file instead
+# (a short header, then state_dtype records appended a chunk at a time),
+# so whatever has been recorded survives a crash or interrupt.
+
+
+
+import ctypes
+import json
+import os
+import pickle
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+
+
+
+#############
+### Variables
+#############
+
+format_version = 1
+
+# the parts of the vJoy state our recordings set (see macro_handler.xinput_macro_to_vjoy_macro)
+button_label = 'lButtons'
+axis_labels = ('wAxisX', 'wAxisY', 'wAxisZ', 'wAxisXRot', 'wAxisYRot', 'wAxisZRot')
+
+# one row per recorded state
+state_dtype = np.dtype([('time', '<f8'), (button_label, '<i4')] + [(label, '<i4') for label in axis_labels])
+
+macro_key_fmt = 'macro:{0}' # .npz member holding a macro's states
+hz_key_fmt = 'hz:{0}' # .npz member holding a macro's recording rate
+devices_key_fmt = 'devices:{0}' # .npz member holding each state's bDevice (uint8), unless they're all 0
+checkpoints_key_fmt = 'checkpoints:{0}' # .npz member holding JSON of a macro's visual checkpoints, if it has any
+version_key = 'format_version'
+extras_key = 'extras' # JSON of any non-macro entries of the macro dictionary (e.g. 'settings')
+
+stream_magic = b'XPBMACRO' # start of a stream file
+stream_header = struct.Struct('<8sIf8x') # magic, format_version, Hz (padded to 24 bytes)
+
+
+
+class _JoystickPosition(ctypes.Structure):
+    """Same layout as the vJoy SDK's JOYSTICK_POSITION_V2 (i.e. pyvjoy._sdk._JOYSTICK_POSITION_V2).
+    Lets us read pickled macros without pyvjoy installed."""
+    _fields_ = [('bDevice', ctypes.c_ubyte)] \
+        + [(label, ctypes.c_int32) for label in ( # LONG
+            'wThrottle', 'wRudder', 'wAileron', 'wAxisX', 'wAxisY', 'wAxisZ', 'wAxisXRot', 'wAxisYRot', 'wAxisZRot',
+            'wSlider', 'wDial', 'wWheel', 'wAxisVX', 'wAxisVY', 'wAxisVZ', 'wAxisVBRX', 'wAxisVBRY', 'wAxisVBRZ',
+            'lButtons')] \
+        + [(label, ctypes.c_uint32) for label in ('bHats', 'bHatsEx1', 'bHatsEx2', 'bHatsEx3')] \
+        + [(label, ctypes.c_int32) for label in ('lButtonsEx1', 'lButtonsEx2', 'lButtonsEx3')]
+
+joystick_dtype = np.dtype(_JoystickPosition) # to view raw struct bytes as NumPy records
+
+
+
+class _MacroUnpickler(pickle.Unpickler):
+    """Unpickles macro dictionaries into _JoystickPosition structs, so pyvjoy isn't needed."""
+    def find_class(self, module, name):
+        if (module, name) == ('pyvjoy._sdk', '_JOYSTICK_POSITION_V2'):
+            return _JoystickPosition
+        return super().find_class(module, name)
+
+
+
+#########
+## FUNCTIONS
+#########
+
+def default_struct_type():
+    """pyvjoy._sdk._JOYSTICK_POSITION_V2, or _JoystickPosition where pyvjoy isn't installed (e.g. in a simulation)."""
+    try:
+        import pyvjoy._sdk
+    except ImportError:
+        return _JoystickPosition
+    return pyvjoy._sdk._JOYSTICK_POSITION_V2
+
+
+def is_macro(value):
+    """Whether value (an entry of a macro dictionary) is a macro, rather than e.g. the 'settings' entry."""
+    return isinstance(value, Mapping) and 'states' in value and 'times' in value
+
+
+def states_to_columns(states, times):
+    """Convert a list of vJoy structs and their times into a state_dtype structured array."""
+    columns = np.zeros(len(states), dtype = state_dtype)
+    columns['time'] = times
+    if len(states):
+        # every struct is laid out like _JoystickPosition, so read them all at once
+        raw = np.frombuffer(b''.join(bytes(s) for s in states), dtype = joystick_dtype)
+        columns[button_label] = raw[button_label]
+        for label in axis_labels:
+            columns[label] = raw[label]
+    return columns
+
+
+def states_to_devices(states):
+    """Each vJoy struct's bDevice, as a uint8 np.ndarray (kept apart from the state_dtype columns)."""
+    if not len(states):
+        return np.zeros(0, dtype = np.uint8)
+    return np.frombuffer(b''.join(bytes(s) for s in states), dtype = joystick_dtype)['bDevice'].copy()
+
+
+def columns_to_states(columns, struct_type = None, devices = None):
+    """
+    Convert a state_dtype structured array back into a list of vJoy structs (what macro_handler.run_macro plays).
+    struct_type defaults to default_struct_type(). devices (see states_to_devices()) fills in bDevice (default 0).
+    """
+    if struct_type is None:
+        struct_type = default_struct_type()
+    structs = (struct_type * len(columns))()
+    if len(columns):
+        raw = np.frombuffer(structs, dtype = joystick_dtype) # writes go straight into the structs
+        raw[button_label] = columns[button_label]
+        for label in axis_labels:
+            raw[label] = columns[label]
+        if devices is not None:
+            raw['bDevice'] = devices
+    return list(structs)
+
+
+def columns_to_macro(columns, hz = None, struct_type = None, devices = None):
+    """Macro dictionary (as returned by macro_handler.record_gamepad_reader) from a state_dtype structured array."""
+    return {'states': columns_to_states(columns, struct_type, devices), 'times': columns['time'].tolist(), 'Hz': hz}
+
+
+def save_macros(fpath, macro_dd):
+    """
+    Save a macro dictionary (label -> macro dict) to fpath as an uncompressed .npz.
+    Entries that aren't macros (e.g. 'settings') are kept as JSON, as are macros' 'checkpoints'.
+    States' bDevice is kept alongside the columns (if any are set).
+    """
+    arrays = {version_key: np.array(format_version)}
+    extras = {}
+    for (label, value) in macro_dd.items():
+        if is_macro(value):
+            arrays[macro_key_fmt.format(label)] = states_to_columns(value['states'], value['times'])
+            arrays[hz_key_fmt.format(label)] = np.array(np.nan if value.get('Hz') is None else value['Hz'], dtype = '<f8')
+            devices = states_to_devices(value['states'])
+            if devices.any():
+                arrays[devices_key_fmt.format(label)] = devices
+            if value.get('checkpoints'):
+                arrays[checkpoints_key_fmt.format(label)] = np.array(json.dumps(value['checkpoints']))
+        else:
+            extras[label] = value
+    arrays[extras_key] = np.array(json.dumps(extras))
+    with open(fpath, mode = 'wb') as f: # (np.savez would append '.npz' to a path without it)
+        np.savez(f, **arrays)
+
+
+def load_macro_pickle(fpath):
+    """Load a pickled macro dictionary, with states as _JoystickPosition structs (no pyvjoy needed)."""
+    with open(fpath, mode = 'rb') as f:
+        return _MacroUnpickler(f).load()
+
+
+def convert_pickle(pickle_fpath, npz_fpath):
+    """Convert a pickled macro dictionary to the columnar format."""
+    save_macros(npz_fpath, load_macro_pickle(pickle_fpath))
+
+
+def save_macro_pickle(fpath, macros):
+    """Write macros (a MacroLibrary or macro dictionary) back out in the old pickled format (needs pyvjoy)."""
+    import pyvjoy._sdk
+    macro_dd = {}
+    for (label, value) in macros.items():
+        if is_macro(value):
+            columns = states_to_columns(value['states'], value['times'])
+            checkpoints = value.get('checkpoints')
+            value = columns_to_macro(columns, value.get('Hz'), pyvjoy._sdk._JOYSTICK_POSITION_V2, states_to_devices(value['states']))
+            if checkpoints:
+                value['checkpoints'] = checkpoints
+        macro_dd[label] = value
+    with open(fpath, mode = 'wb') as f:
+        pickle.dump(macro_dd, f)
+
+
+
+def read_macro_stream(fpath):
+    """
+    Read a stream file written by MacroStreamWriter.
+    Returns (state_dtype structured array, Hz). A partially written last record (e.g. after a crash) is dropped.
+    """
+    with open(fpath, mode = 'rb') as f:
+        magic, version, hz = stream_header.unpack(f.read(stream_header.size))
+        if magic != stream_magic:
+            raise ValueError("{0} isn't a macro stream file.".format(fpath))
+        if version > format_version:
+            raise ValueError("{0} has macro format version {1}; only up to {2} is supported.".format(fpath, version, format_version))
+        data = f.read()
+    n = len(data) // state_dtype.itemsize
+    return np.frombuffer(data, dtype = state_dtype, count = n).copy(), hz
+
+
+
+class MacroStreamWriter:
+    """
+    Append-only writer for recordings in progress.
+    Rows are buffered chunk_size at a time and each full chunk is written and flushed to disk,
+    so memory use stays bounded and at most one chunk is lost if the process dies.
+    """
+    def __init__(self, fpath, hz, chunk_size = 256):
+        self.fpath = fpath
+        self.n_written = 0
+        self._chunk = np.zeros(chunk_size, dtype = state_dtype)
+        self._n_buffered = 0
+        self._f = open(fpath, mode = 'wb')
+        self._f.write(stream_header.pack(stream_magic, format_version, hz))
+        self._f.flush()
+
+    def append(self, rows):
+        """Append rows (a state_dtype structured array)."""
+        for row in rows:
+            self._chunk[self._n_buffered] = row
+            self._n_buffered += 1
+            if self._n_buffered == len(self._chunk):
+                self.flush()
+
+    def flush(self):
+        """Write out whatever is buffered."""
+        if self._n_buffered:
+            self._f.write(self._chunk[:self._n_buffered].tobytes())
+            self.n_written += self._n_buffered
+            self._n_buffered = 0
+        self._f.flush()
+
+    def close(self):
+        if not self._f.closed:
+            self.flush()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+def open_macros(fpath):
+    """
+    Open the macro dictionary at fpath without loading any macros yet.
+    If fpath is a pickle and a converted .npz with the same name sits next to it, that's used instead
+    (converted again first if the pickle has been changed since).
+    Returns a MacroLibrary for .npz files and a PickledMacros otherwise.
+    """
+    base, ext = os.path.splitext(fpath)
+    if ext == '.npz':
+        return MacroLibrary(fpath)
+    npz_fpath = base + '.npz'
+    if os.path.exists(npz_fpath):
+        if os.path.exists(fpath) and os.path.getmtime(fpath) > os.path.getmtime(npz_fpath):
+            print("{0} is newer than {1}; converting it again.".format(fpath, npz_fpath))
+            convert_pickle(fpath, npz_fpath)
+        return MacroLibrary(npz_fpath)
+    return PickledMacros(fpath)
+
+
+
+class PickledMacros(Mapping):
+    """A pickled macro dictionary that's only unpickled the first time it's used
+    (into _JoystickPosition structs if pyvjoy isn't installed; see default_struct_type())."""
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._macro_dd = None
+
+    def _load(self):
+        if self._macro_dd is None:
+            if default_struct_type() is _JoystickPosition:
+                self._macro_dd = load_macro_pickle(self.fpath)
+            else:
+                with open(self.fpath, mode = 'rb') as f:
+                    self._macro_dd = pickle.load(f)
+        return self._macro_dd
+
+    def __getitem__(self, label):
+        return self._load()[label]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+
+class MacroLibrary(Mapping):
+    """
+    Read-only, lazily loaded macro dictionary backed by a file written by save_macros().
+    library[label] gives the same macro dict the pickled format did ('states', 'times', 'Hz'),
+    built on first access and cached. library.columns(label) gives the raw structured array.
+    """
+    def __init__(self, fpath, struct_type = None):
+        self.fpath = fpath
+        self.struct_type = struct_type
+        self._npz = np.load(fpath, allow_pickle = False) # only reads the index until members are accessed
+        version = int(self._npz[version_key])
+        if version > format_version:
+            raise ValueError("{0} has macro format version {1}; only up to {2} is supported.".format(fpath, version, format_version))
+        prefix = macro_key_fmt.format('')
+        self.labels = [k[len(prefix):] for k in self._npz.files if k.startswith(prefix)]
+        self.extras = json.loads(str(self._npz[extras_key]))
+        self._macros = {}
+
+    def columns(self, label):
+        """state_dtype structured array for label."""
+        return self._npz[macro_key_fmt.format(label)]
+
+    def hz(self, label):
+        hz = float(self._npz[hz_key_fmt.format(label)])
+        return None if np.isnan(hz) else hz
+
+    def devices(self, label):
+        """Each of label's states' bDevice (uint8 np.ndarray), or None if they're all 0."""
+        key = devices_key_fmt.format(label)
+        return self._npz[key] if key in self._npz.files else None
+
+    def checkpoints(self, label):
+        """label's visual checkpoints (see macro_handler.add_checkpoint()); empty if it has none."""
+        key = checkpoints_key_fmt.format(label)
+        return json.loads(str(self._npz[key])) if key in self._npz.files else []
+
+    def __getitem__(self, label):
+        if label in self._macros:
+            return self._macros[label]
+        if label in self.extras:
+            return self.extras[label]
+        if label not in self.labels:
+            raise KeyError(label)
+        macro = self._macros[label] = columns_to_macro(self.columns(label), self.hz(label), self.struct_type, self.devices(label))
+        checkpoints = self.checkpoints(label)
+        if checkpoints:
+            macro['checkpoints'] = checkpoints
+        return macro
+
+    def __contains__(self, label): # (Mapping's default would load the macro)
+        return label in self.labels or label in self.extras
+
+    def __iter__(self):
+        yield from self.labels
+        yield from self.extras
+
+    def __len__(self):
+        return len(self.labels) + len(self.extras)
+
+    def close(self):
+        self._npz.close()
+
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) != 3:
+        print("Usage: python macro_format.py <macro_dd.p> <macro_dd.npz>")
+    else:
+        convert_pickle(argv[1], argv[2])
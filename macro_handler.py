@@ -19,16 +19,23 @@
 # In[1]:
 
 
-import pyxinput
+# pyxinput and pyvjoy (Windows-only) are imported only by the functions that need them,
+# so loading this module (e.g. to play back or convert macros) stays cheap
 
 from enum import Enum
-import pyvjoy
+import os
 import time
 
 import pickle # to save macros
+import numpy as np # batch conversion
+import macro_format # columnar macro states
 
 import re
 
+import sys
+import threading
+from collections import deque
+    # MacroPlayer's thread and command queue
 from time import perf_counter as _time
 
 
@@ -76,23 +83,31 @@ def build_vjoy_button_mapping(xinput_buttons):
 vjoy_buttons = build_vjoy_button_mapping(xinput_buttons)
 vjoy_id_to_button = {v:k for (k,v) in vjoy_buttons.items()}
 
+# axis IDs from vjoy SDK (same values as pyvjoy.HID_USAGE_*; see axis_to_int below)
+HID_USAGE_X = 0x30
+HID_USAGE_Y = 0x31
+HID_USAGE_Z = 0x32
+HID_USAGE_RX = 0x33
+HID_USAGE_RY = 0x34
+HID_USAGE_RZ = 0x35
+
 vjoy_axisid_to_axislabel = {
-    pyvjoy.HID_USAGE_X: 'wAxisX',
-    pyvjoy.HID_USAGE_Y: 'wAxisY',
-    pyvjoy.HID_USAGE_Z: 'wAxisZ',
-    pyvjoy.HID_USAGE_RX: 'wAxisXRot',
-    pyvjoy.HID_USAGE_RY: 'wAxisYRot',
-    pyvjoy.HID_USAGE_RZ: 'wAxisZRot'
+    HID_USAGE_X: 'wAxisX',
+    HID_USAGE_Y: 'wAxisY',
+    HID_USAGE_Z: 'wAxisZ',
+    HID_USAGE_RX: 'wAxisXRot',
+    HID_USAGE_RY: 'wAxisYRot',
+    HID_USAGE_RZ: 'wAxisZRot'
 }
 
 # keys based on pyxinput labels
 axis_mapping = {
-    'thumb_lx': pyvjoy.HID_USAGE_X,
-    'thumb_ly': pyvjoy.HID_USAGE_Y,
-    'left_trigger': pyvjoy.HID_USAGE_Z,
-    'thumb_rx': pyvjoy.HID_USAGE_RX,
-    'thumb_ry': pyvjoy.HID_USAGE_RY,
-    'right_trigger': pyvjoy.HID_USAGE_RZ
+    'thumb_lx': HID_USAGE_X,
+    'thumb_ly': HID_USAGE_Y,
+    'left_trigger': HID_USAGE_Z,
+    'thumb_rx': HID_USAGE_RX,
+    'thumb_ry': HID_USAGE_RY,
+    'right_trigger': HID_USAGE_RZ
 }
 
 
@@ -121,10 +136,164 @@ AXIS_OFFSET = 0x4000
 # xinput triggers go from 0 to 0xff
 TRIGGER_SCALE_FACTOR = 0x7fff / 0xff
 
+# playback timing
+SPIN_TIME = 0.002 # seconds before each deadline that schedulers stop sleeping and busy-wait instead
+LATE_TOLERANCE = 0.001 # updates later than this (in seconds) count as late in PlaybackStats
+
+
+
+
+
+
+
+
+
+#########
+## Playback schedulers
+#########
+
+# A scheduler's wait_until(deadline) returns as soon after deadline (a now() value) as it can.
+# Given an interrupt (threading.Event), it also returns as soon as that's set:
+# the coarse part of the wait blocks on the Event itself, so only the last, precise part doesn't notice it.
+# now() is time.perf_counter(), except for schedulers that simulate time (VirtualScheduler).
+# run_macro() uses one to time each controller update.
+# idle(deadline) also waits until deadline, but for when nothing is being timed (e.g. polling for a checkpoint),
+# so it doesn't need to be precise.
+
+class SleepScheduler:
+    """Just time.sleep() until the deadline. Cheap, but at the mercy of the OS timer's resolution."""
+    now = staticmethod(_time)
+
+    def wait_until(self, deadline, interrupt = None):
+        _coarse_wait(deadline - _time(), interrupt)
+
+    idle = wait_until
+
+
+class SpinScheduler:
+    """time.sleep() until spin_time before the deadline, then busy-wait the rest of the way.
+    Burns a bit of CPU per update in exchange for sub-millisecond accuracy."""
+    now = staticmethod(_time)
+
+    def __init__(self, spin_time = SPIN_TIME):
+        self.spin_time = spin_time
 
+    def wait_until(self, deadline, interrupt = None):
+        if _coarse_wait(deadline - _time() - self.spin_time, interrupt):
+            return
+        while _time() < deadline:
+            pass
 
+    def idle(self, deadline):
+        _coarse_wait(deadline - _time())
 
 
+class TimerfdScheduler(SpinScheduler):
+    """Like SpinScheduler, but the coarse wait blocks on a Linux timerfd instead of time.sleep()
+    (or on the interrupt, if there is one). Needs os.timerfd_create (Linux, Python 3.13+)."""
+    def __init__(self, spin_time = SPIN_TIME):
+        super().__init__(spin_time)
+        self._fd = os.timerfd_create(time.CLOCK_MONOTONIC)
+
+    def wait_until(self, deadline, interrupt = None):
+        remaining = deadline - _time() - self.spin_time
+        if interrupt is not None:
+            if _coarse_wait(remaining, interrupt):
+                return
+        elif remaining > 0:
+            os.timerfd_settime(self._fd, initial = remaining)
+            os.read(self._fd, 8) # blocks until the timer fires
+        while _time() < deadline:
+            pass
+
+    def __del__(self):
+        fd = getattr(self, '_fd', None) # (not set if timerfd_create() failed)
+        if fd is not None:
+            os.close(fd)
+
+
+class VirtualScheduler:
+    """Doesn't wait at all: now() is simulated time, which jumps straight to each deadline.
+    For playing macros on a fake controller (see simulation) as fast as possible;
+    lateness then only measures the time spent between updates.
+    Every idle() is passed on, as listener('idle', now(), None), to every callable in self.listeners
+    (e.g. so a simulation's frames can move on while a bot waits for them to)."""
+    def __init__(self):
+        self.skipped = 0.0 # seconds of waiting skipped so far
+        self.listeners = []
+
+    def now(self):
+        return _time() + self.skipped
+
+    def wait_until(self, deadline, interrupt = None):
+        remaining = deadline - self.now()
+        if remaining > 0:
+            self.skipped += remaining
+
+    def idle(self, deadline):
+        self.wait_until(deadline)
+        t = self.now()
+        for listener in self.listeners:
+            listener('idle', t, None)
+
+
+def _coarse_wait(remaining, interrupt = None):
+    """Sleep remaining seconds (if positive), or until interrupt is set if one is given. Returns whether it was."""
+    if interrupt is not None:
+        return interrupt.wait(remaining) if remaining > 0 else interrupt.is_set()
+    if remaining > 0:
+        time.sleep(remaining)
+    return False
+
+
+default_scheduler = SpinScheduler()
+
+
+
+class PlaybackStats:
+    """
+    How late run_macro() issued each controller update relative to the macro's timeline.
+    Attributes (lateness in seconds):
+        - n_updates: number of updates issued
+        - mean, p99, max: lateness statistics
+        - n_late: updates more than late_tolerance seconds late
+        - updates_saved: updates skipped because the macro was coalesced (see coalesce_macro()),
+            counting only repeats of the states actually sent
+        - checkpoints_passed: visual checkpoints seen in time (see add_checkpoint())
+        - aborted_at: index of the checkpoint that timed out and ended playback early (None if none did)
+        - time_saved: seconds of recorded padding skipped at checkpoints (negative if checkpoints took longer than recorded)
+        - interrupted: whether playback was stopped early from outside (see run_macro()'s interrupt)
+    """
+    def __init__(self, lateness, late_tolerance = LATE_TOLERANCE, updates_saved = 0,
+            checkpoints_passed = 0, aborted_at = None, time_saved = 0.0, interrupted = False):
+        self.lateness = lateness
+        self.interrupted = interrupted
+        self.n_updates = len(lateness)
+        self.updates_saved = updates_saved
+        self.checkpoints_passed = checkpoints_passed
+        self.aborted_at = aborted_at
+        self.time_saved = time_saved
+        ordered = sorted(lateness)
+        self.mean = sum(ordered) / len(ordered) if ordered else 0.0
+        self.p99 = ordered[min(int(0.99 * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+        self.max = ordered[-1] if ordered else 0.0
+        self.n_late = sum(1 for x in ordered if x > late_tolerance)
+
+    @property
+    def aborted(self):
+        return self.aborted_at is not None
+
+    def __str__(self):
+        s = "{0} updates ({5} saved), lateness mean {1:.3f} ms / p99 {2:.3f} ms / max {3:.3f} ms, {4} late".format(
+            self.n_updates, 1000 * self.mean, 1000 * self.p99, 1000 * self.max, self.n_late, self.updates_saved)
+        if self.checkpoints_passed or self.aborted:
+            s += ", {0} checkpoints passed ({1:.2f} s saved)".format(self.checkpoints_passed, self.time_saved)
+        if self.aborted:
+            s += ", aborted at checkpoint {0}".format(self.aborted_at)
+        if self.interrupted:
+            s += ", interrupted"
+        return s
+
 
 
 
@@ -144,6 +313,7 @@ def test_controller_slot(slot_no=1):
     Otherwise, type anything when prompted and it will return
     a handle to the gamepad reader.
     """
+    import pyxinput
     reader = pyxinput.rController(slot_no)
     for _ in range(20):
         print(reader.gamepad)
@@ -184,11 +354,57 @@ def convert_to_vjoy_buttons(xinput_num, vjoy_mapping = vjoy_buttons, xinput_mapp
     return converted_buttons
     
     
+def build_vjoy_button_lut(vjoy_mapping = vjoy_buttons, xinput_mapping = xinput_buttons):
+    """Table of every possible xinput button word (0 - 0xffff) -> the corresponding vjoy button word,
+    i.e. convert_to_vjoy_buttons() precomputed."""
+    xinput_nums = np.arange(0x10000)
+    lut = np.zeros(0x10000, dtype = np.int32)
+    for (k,v) in xinput_mapping.items():
+        lut[(xinput_nums & v) != 0] |= (1 << (vjoy_mapping[k]-1))
+    return lut
+
+vjoy_button_lut = build_vjoy_button_lut()
+
+
+def xinput_macro_to_columns(macro, times = None, button_lut = vjoy_button_lut):
+    """
+    Convert states in macro (list of pyxinput.rController().state's) into a macro_format.state_dtype structured array
+    in one vectorized pass (times, if given, fills the 'time' column).
+    Gives the same values as convert_to_vjoy_buttons() and convert_to_vjoy_axis_range() do state-by-state.
+    """
+    states = [state.__dict__() for state in macro] # convert pxyinput.rController().gamepad to easier-to-handle form
+    columns = np.zeros(len(states), dtype = macro_format.state_dtype)
+    if times is not None:
+        columns['time'] = times
+    if not states:
+        return columns
+
+    # buttons
+    columns['lButtons'] = button_lut[np.fromiter((s['wButtons'] for s in states), dtype = np.int64, count = len(states)) & 0xffff]
+
+    # axes -- the rest of the items
+    for k in states[0]:
+        if k == 'wButtons':
+            continue
+        values = np.fromiter((s[k] for s in states), dtype = np.int64, count = len(states))
+        if 'trigger' in k:
+            values = (TRIGGER_SCALE_FACTOR * values).astype(np.int64) # truncates, like int()
+        elif 'thumb' in k:
+            values = (values//2) + AXIS_OFFSET
+        columns[vjoy_axisid_to_axislabel[axis_mapping[k]]] = values
+    return columns
+
+
 def xinput_macro_to_vjoy_macro(macro, button_converter = convert_to_vjoy_buttons, axis_converter = convert_to_vjoy_axis_range):
     """Convert states in macro (list of pyxinput.rController().state's) into (list of vjoy-compatible data structs).
     
     Does conversion based on passed-in mappings. (Some ID->label mappings outside the function are used.)
+    With the default converters, everything is converted at once (see xinput_macro_to_columns()).
     """
+    import pyvjoy._sdk
+    if button_converter is convert_to_vjoy_buttons and axis_converter is convert_to_vjoy_axis_range:
+        return macro_format.columns_to_states(xinput_macro_to_columns(macro), pyvjoy._sdk._JOYSTICK_POSITION_V2)
+
     converted = []
     vjoy_struct = None
     
@@ -227,19 +443,19 @@ def record_gamepad_reader(reader, refresh_rate, converter = xinput_macro_to_vjoy
     
     Note: Playback conditions must be very close to recording conditions to ensure accuracy.
     That means inconsistent framerates can cause playback desync.
+
+    For long recordings, prefer record_gamepad_stream(), which doesn't hold everything in memory.
     """
     states = []
     times = []
     wait_time = 1/refresh_rate
+    scheduler = SleepScheduler()
     start = _time()
     try:
         while True:
-            cur_time = _time()
-                # wait until it's time to update
-            try:
-                time.sleep(wait_time + cur_time - _time())
-            except ValueError:
-                pass
+                # wait until it's time to sample
+                # (deadlines are relative to start, so the sample period doesn't drift)
+            scheduler.wait_until(start + len(states) * wait_time)
 
             # now add (processing occurs after the end of recording)
                 # takes ~5 us for the following line to complete
@@ -257,6 +473,91 @@ def record_gamepad_reader(reader, refresh_rate, converter = xinput_macro_to_vjoy
     return {'states': states, 'times': times, 'Hz': refresh_rate}
 
 
+def record_gamepad_stream(reader, refresh_rate, fpath, chunk_size = 256, max_samples = None, scheduler = None):
+    """
+    Record states from reader refresh_rate times a second into the stream file fpath
+    until a KeyboardInterrupt is received (or max_samples have been recorded).
+    Samples are taken on absolute deadlines (start + n/refresh_rate), converted to vJoy values as they arrive
+    (see xinput_macro_to_columns()), and appended to disk a chunk at a time (see macro_format.MacroStreamWriter),
+    so memory use doesn't grow and an interrupted recording keeps everything captured so far.
+
+    reader can be anything with a .gamepad attribute shaped like pyxinput.rController().gamepad (e.g. a fake, for testing).
+    scheduler defaults to a SleepScheduler.
+    Returns the number of samples recorded. Load the recording with macro_format.read_macro_stream(fpath).
+    """
+    if scheduler is None:
+        scheduler = SleepScheduler()
+    period = 1/refresh_rate
+    n = 0
+    with macro_format.MacroStreamWriter(fpath, refresh_rate, chunk_size) as writer:
+        start = _time()
+        try:
+            while max_samples is None or n < max_samples:
+                scheduler.wait_until(start + n * period)
+                gamepad, t = reader.gamepad, _time() - start
+                writer.append(xinput_macro_to_columns([gamepad], [t]))
+                n += 1
+        except KeyboardInterrupt:
+            pass
+    return n
+
+
+
+def coalesce_macro(macro_dict):
+    """
+    Collapse runs of identical consecutive states into one timed event each.
+    Recordings sample the gamepad at a fixed rate, so most states just repeat the previous one;
+    re-sending them doesn't change what the controller reports, so they can be skipped.
+    Returns a new macro dict with the kept 'states' and 'times', plus
+        - 'duration': when the original timeline ended (run_macro() still waits until then before resetting)
+        - 'n_recorded': how many states the original had
+        - 'repeats': how many recorded states each kept one stands in for, besides itself
+    Playback of the result is indistinguishable from playback of macro_dict, with fewer driver calls.
+    """
+    states, times = macro_dict['states'], macro_dict['times']
+    old_repeats = macro_dict.get('repeats', [0] * len(states))
+    kept_states, kept_times, repeats = [], [], []
+    prev = None
+    for (state, t, n) in zip(states, times, old_repeats):
+        raw = bytes(state)
+        if raw != prev:
+            kept_states.append(state)
+            kept_times.append(t)
+            repeats.append(n)
+            prev = raw
+        else:
+            repeats[-1] += 1 + n
+    coalesced = dict(macro_dict)
+    coalesced.update({'states': kept_states, 'times': kept_times, 'repeats': repeats,
+        'duration': times[-1] if len(times) else 0.0,
+        'n_recorded': macro_dict.get('n_recorded', len(states))})
+    return coalesced
+
+
+
+def add_checkpoint(macro_dict, time, template, region = None, resume = None, threshold = None, timeout = None):
+    """
+    Make playback of macro_dict wait, at time (seconds into its timeline), until template shows up on screen.
+    Inputs:
+        - template: path of the template image.
+        - region: (x, y, w, h) of the part of the window to look in (None -> the whole window).
+        - resume: where in the timeline to carry on from once the template is seen (default: time).
+            Set it to the end of the idle padding recorded after time (e.g. a loading screen),
+            so the padding only lasts as long as the game actually takes.
+        - threshold, timeout: minimum match value and how long (in seconds) to keep looking before giving up
+            (defaults are up to whoever checks the checkpoint; see bot_vision.BotView.wait_for_checkpoint()).
+    Checkpoints are kept, in time order, as dicts in macro_dict['checkpoints'] (and saved by macro_format.save_macros()).
+    """
+    checkpoint = {'time': time, 'template': template}
+    for (k, v) in (('region', region), ('resume', resume), ('threshold', threshold), ('timeout', timeout)):
+        if v is not None:
+            checkpoint[k] = list(v) if k == 'region' else v
+    checkpoints = macro_dict.setdefault('checkpoints', [])
+    checkpoints.append(checkpoint)
+    checkpoints.sort(key = lambda c: c['time'])
+    return checkpoint
+
+
 
 def write_gamepad_values(j, state):
     """Given a gamepad (j) and a state, update gamepad."""
@@ -268,39 +569,225 @@ def write_gamepad_values(j, state):
 
 
 
-def run_macro(j, macro_dict):
-    """Run specified macro. Resets controller when done.
+def run_macro(j, macro_dict, scheduler = None, checkpoint_wait = None, interrupt = None, reset = True):
+    """Run specified macro. Resets controller when done (unless reset is False).
+    Each update is timed by scheduler (default_scheduler if None).
+    macro_dict may have been through coalesce_macro().
+    Returns a PlaybackStats of how late each update was.
+
+    If checkpoint_wait is given and macro_dict has 'checkpoints' (see add_checkpoint()),
+    playback stops at each checkpoint's time and calls checkpoint_wait(checkpoint), which should block until
+    the checkpoint is seen (returning True) or give up (returning False).
+    On True, the timeline carries on from the checkpoint's 'resume' time (skipping any states recorded before it);
+    on False, the rest of the macro is abandoned (see PlaybackStats.aborted_at).
+
+    If interrupt (a threading.Event) is given, playback stops as soon as it's set (see MacroPlayer);
+    at worst, after the scheduler's final busy-wait before an update.
 
     There can be slight variation in repeated playback iterations, 
     but it is unclear whether this is due to imperfections in recording/playback
     or fluctuations in the state of the target program (or its host machine).
     """
     states, times = macro_dict['states'], macro_dict['times']
+    if scheduler is None:
+        scheduler = default_scheduler
+    checkpoints = list(macro_dict.get('checkpoints', ())) if checkpoint_wait is not None else []
+    now = scheduler.now
+    lateness = []
+    passed, aborted_at, time_saved = 0, None, 0.0
+    repeats = macro_dict.get('repeats')
+    updates_saved = 0 # only counted for updates actually sent, in case playback stops early
+
+    def wait_until(deadline):
+        """scheduler.wait_until(deadline), cut short if interrupt is set. False if it was."""
+        if interrupt is None:
+            scheduler.wait_until(deadline)
+            return True
+        scheduler.wait_until(deadline, interrupt)
+        return not interrupt.is_set()
     
     try:
-        start = _time()
+        start = now()
         # loop through the states
-        for i,target_time in enumerate(times):
+        # deadlines are all relative to start, so lateness in one update doesn't carry over into the next
+        i = 0
+        while i < len(times) or passed < len(checkpoints):
+            if passed < len(checkpoints) and (i >= len(times) or times[i] > checkpoints[passed]['time']):
+                    # wait for the screen to catch up, then jump the timeline to the checkpoint's resume time
+                checkpoint = checkpoints[passed]
+                if not wait_until(start + checkpoint['time']):
+                    break
+                reached = now()
+                if not checkpoint_wait(checkpoint):
+                    if interrupt is None or not interrupt.is_set(): # (an interrupted wait isn't a timeout)
+                        aborted_at = passed
+                    break
+                resume = checkpoint.get('resume', checkpoint['time'])
+                time_saved += (resume - checkpoint['time']) - (now() - reached)
+                start = now() - resume
+                skipped = None
+                while i < len(times) and times[i] < resume:
+                    skipped = states[i]
+                    i += 1
+                if skipped is not None: # put the controller where the timeline would have it by now
+                    j.Data.set_data(skipped)
+                    j.update()
+                passed += 1
+                continue
+
                 # do all work besides update
             j.Data.set_data(states[i])
 
                 # wait until it's time to update
-                # using time.sleep() prevents intense and unnecessary CPU burn (compared to a while-loop wait)
-                # but sometimes the argument of time.sleep() is slightly negative (-10E-4 or so)
-                # so we have to catch the ValueError
-                # thankfully, just ignoring it is generally fine given the time-resolution of what we're doing
-                # (it's not like gamepad input is handled at >1kHz)
-            try:
-                time.sleep(target_time + start - _time())
-            except ValueError:
-                pass
+            deadline = start + times[i]
+            if not wait_until(deadline):
+                break
+            lateness.append(now() - deadline)
                 # now actually update controller
             j.update()
+            if repeats is not None:
+                updates_saved += repeats[i]
+            i += 1
+        else:
+            if 'duration' in macro_dict: # coalesced macro: hold the last state as long as the original would have
+                wait_until(start + macro_dict['duration'])
     except KeyboardInterrupt:
         pass
     finally:
-        j.reset()
-        return
-    
+        if reset:
+            j.reset()
+    return PlaybackStats(lateness, updates_saved = updates_saved,
+        checkpoints_passed = passed, aborted_at = aborted_at, time_saved = time_saved,
+        interrupted = interrupt is not None and interrupt.is_set())
+
+
 
-    
\ No newline at end of file
+class MacroPlayer(threading.Thread):
+    """
+    Plays macros on controller j from its own thread, so whoever starts them can keep working (e.g. watching the screen).
+    Macros are queued with start() and played one after another; abort() stops the current one and drops the queue,
+    splice() cuts the current one short and plays another right away (before anything queued),
+    progress() tells what's playing and how far along it is, and wait() blocks until everything queued has played.
+    Stats of each finished macro are in self.last_stats (a PlaybackStats).
+    If playing a macro raises (e.g. the controller fails), the queue is dropped and the exception is kept in self.error
+    until wait() re-raises it on the caller's thread; the player itself carries on.
+
+    Macros are played with run_macro(). Their checkpoints are only waited for if a checkpoint_wait is queued along with them;
+    it's called on the player thread (see bot_vision.BotView.run_macro_watched() for one that has the watching thread look).
+    The thread asks the OS for a raised priority where it can (time-critical on Windows; best effort elsewhere).
+    Note the GIL: the player still needs it between updates, so keep other Python threads' work coarse-grained
+    (cv2 calls release it) for tight timing.
+    """
+    def __init__(self, j, scheduler = None, raise_priority = True):
+        super().__init__(daemon = True)
+        self.j = j
+        self.scheduler = scheduler
+        self.raise_priority = raise_priority
+        self.last_stats = None
+        self.error = None # exception raised while playing, until wait() re-raises it
+        self._commands = deque() # (label, macro_dict, checkpoint_wait) to play, in order
+        self._cond = threading.Condition()
+        self._current = None # (label, macro_dict, start time, interrupt Event) while playing
+        self._stopping = False
+
+    def start_macro(self, label, macro_dict, checkpoint_wait = None):
+        """Queue macro_dict (called label) to play after whatever's playing or queued.
+        checkpoint_wait is passed on to run_macro() (None -> checkpoints are ignored)."""
+        with self._cond:
+            self._commands.append((label, macro_dict, checkpoint_wait))
+            self._cond.notify_all()
+
+    def splice(self, label, macro_dict, checkpoint_wait = None):
+        """Stop the current macro and play macro_dict next, ahead of anything queued.
+        The controller isn't reset in between, so held inputs carry over until macro_dict's first state."""
+        with self._cond:
+            self._commands.appendleft((label, macro_dict, checkpoint_wait))
+            if self._current is not None:
+                self._current[3].set()
+            self._cond.notify_all()
+
+    def abort(self):
+        """Stop the current macro (resetting the controller) and drop everything queued."""
+        with self._cond:
+            self._commands.clear()
+            if self._current is not None:
+                self._current[3].set()
+            self._cond.notify_all()
+
+    def progress(self):
+        """(label, seconds played, macro length in seconds, number of macros queued after it), or None if idle."""
+        with self._cond:
+            if self._current is None:
+                return None
+            label, macro_dict, start, _ = self._current
+            n_queued = len(self._commands)
+        length = macro_dict.get('duration', macro_dict['times'][-1] if len(macro_dict['times']) else 0.0)
+        return label, self._now() - start, length, n_queued
+
+    def busy(self):
+        with self._cond:
+            return self._current is not None or bool(self._commands)
+
+    def wait(self, timeout = None):
+        """Block until nothing is playing or queued (or timeout seconds pass). Returns whether that's the case.
+        Raises whatever playback raised on the player thread, if anything did (see self.error)."""
+        with self._cond:
+            done = self._cond.wait_for(lambda: (self._current is None and not self._commands) or self.error is not None, timeout)
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return done
+
+    def stop(self):
+        """Abort playback and end the thread."""
+        with self._cond:
+            self._stopping = True
+        self.abort()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        if self.raise_priority:
+            _raise_thread_priority()
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._commands or self._stopping)
+                if self._stopping:
+                    return
+                label, macro_dict, checkpoint_wait = self._commands.popleft()
+                interrupt = threading.Event()
+                self._current = (label, macro_dict, self._now(), interrupt)
+            try:
+                try:
+                    self.last_stats = run_macro(self.j, macro_dict, self.scheduler, checkpoint_wait, interrupt, reset = False)
+                finally:
+                    with self._cond:
+                        spliced = interrupt.is_set() and bool(self._commands) and not self._stopping
+                    if not spliced:
+                        self.j.reset()
+            except BaseException as e: # hand it to whoever's waiting, rather than dying with a macro still "playing"
+                with self._cond:
+                    self._commands.clear()
+                    if self.error is None:
+                        self.error = e
+            finally:
+                with self._cond:
+                    self._current = None
+                    self._cond.notify_all()
+
+    def _now(self):
+        return (self.scheduler or default_scheduler).now()
+
+
+
+def _raise_thread_priority():
+    """Best effort at making the calling thread's scheduling more reliable."""
+    try:
+        if sys.platform == 'win32':
+            from ctypes import windll
+            THREAD_PRIORITY_TIME_CRITICAL = 15
+            windll.kernel32.SetThreadPriority(windll.kernel32.GetCurrentThread(), THREAD_PRIORITY_TIME_CRITICAL)
+        else:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10) # (Linux: per thread; usually needs privileges)
+    except (OSError, AttributeError):
+        pass
@@ -0,0 +1,177 @@
+# coding: utf-8
+
+# Where a bot's time goes.
+#
+# Metrics keeps counters (e.g. attempts, mistakes) and timers (e.g. capture, template matching, each macro)
+# cheaply enough to leave on all the time: recording a timing is a lock and a few additions.
+# Timers and counters can carry labels (e.g. macro = 'advance_rng_seed'); keep their values few.
+#
+# MetricsExporter writes a Metrics out every interval seconds, as
+#     - a line of JSON appended to a .jsonl file (a time series to analyze later), and/or
+#     - a Prometheus text-format file (e.g. for node_exporter's textfile collector), replaced each time.
+
+
+
+import atexit
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter as _time
+from time import time as _wall_time
+
+
+
+prometheus_prefix = 'xpybot_' # prepended to every metric name in Prometheus output
+export_interval = 10.0 # seconds between MetricsExporter writes
+
+
+
+class Metrics:
+    """
+    Counters and timers, keyed by (name, labels).
+    A timer keeps the count, total and max of the durations (in seconds) observed.
+    gauges are callables polled whenever a snapshot is taken (e.g. to report a cache's size).
+    """
+    def __init__(self):
+        self.started = _wall_time()
+        self.gauges = {} # name -> callable returning a number
+        self._counters = {} # (name, labels) -> int
+        self._timers = {} # (name, labels) -> [count, total, max]
+        self._lock = threading.Lock()
+
+    def count(self, name, n = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        """Record a duration for timer name."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._timers.get(key)
+            if stats is None:
+                self._timers[key] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds > stats[2]:
+                    stats[2] = seconds
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """with metrics.timed(name): ... records how long the block took."""
+        start = _time()
+        try:
+            yield
+        finally:
+            self.observe(name, _time() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def timer(self, name, **labels):
+        """(count, total seconds, max seconds) of timer name."""
+        return tuple(self._timers.get((name, tuple(sorted(labels.items()))), (0, 0.0, 0.0)))
+
+    def snapshot(self):
+        """Everything recorded so far, as a JSON-friendly dict."""
+        with self._lock:
+            counters = list(self._counters.items())
+            timers = [(key, list(stats)) for (key, stats) in self._timers.items()]
+        return {
+            'time': _wall_time(),
+            'uptime': _wall_time() - self.started,
+            'counters': [dict(labels, name = name, value = value) for ((name, labels), value) in counters],
+            'timers': [dict(labels, name = name, count = n, sum = total, max = longest) for ((name, labels), (n, total, longest)) in timers],
+            'gauges': {name: gauge() for (name, gauge) in self.gauges.items()},
+        }
+
+    def to_prometheus(self, snapshot = None):
+        """The Prometheus text exposition format of snapshot (default: a new one)."""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = []
+        def add(name, kind, samples):
+            lines.append("# TYPE {0}{1} {2}".format(prometheus_prefix, name, kind))
+            for (suffix, labels, value) in samples:
+                lines.append("{0}{1}{2}{3} {4}".format(prometheus_prefix, name, suffix, _prometheus_labels(labels), value))
+
+        by_name = {}
+        for c in snapshot['counters']:
+            by_name.setdefault(c['name'], []).append(c)
+        for (name, samples) in sorted(by_name.items()):
+            add(name + '_total', 'counter', [('', _labels_of(c, ('name', 'value')), c['value']) for c in samples])
+
+        by_name = {}
+        for t in snapshot['timers']:
+            by_name.setdefault(t['name'], []).append(t)
+        for (name, samples) in sorted(by_name.items()):
+            add(name + '_seconds', 'summary', [(suffix, _labels_of(t, ('name', 'count', 'sum', 'max')), t[field])
+                for t in samples for (suffix, field) in (('_count', 'count'), ('_sum', 'sum'))])
+            add(name + '_seconds_max', 'gauge', [('', _labels_of(t, ('name', 'count', 'sum', 'max')), t['max']) for t in samples])
+
+        for (name, value) in sorted(snapshot['gauges'].items()):
+            add(name, 'gauge', [('', {}, value)])
+        add('uptime_seconds', 'gauge', [('', {}, snapshot['uptime'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_json_line(self, fpath, snapshot = None):
+        """Append snapshot (default: a new one) to fpath as one line of JSON."""
+        with open(fpath, mode = 'a') as f:
+            f.write(json.dumps(snapshot if snapshot is not None else self.snapshot()) + '\n')
+
+    def write_prometheus(self, fpath, snapshot = None):
+        """Replace fpath with the Prometheus text format of snapshot (default: a new one). Readers never see half a file."""
+        tmp = fpath + '.tmp'
+        with open(tmp, mode = 'w') as f:
+            f.write(self.to_prometheus(snapshot))
+        os.replace(tmp, fpath)
+
+
+
+def _labels_of(sample, exclude):
+    return {k: v for (k, v) in sample.items() if k not in exclude}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (k, v) in sorted(labels.items())) + '}'
+
+
+
+class MetricsExporter(threading.Thread):
+    """Writes metrics to json_fpath (appending) and/or prometheus_fpath (replacing) every interval seconds,
+    and once more when stopped (which also happens at interpreter exit)."""
+    def __init__(self, metrics, json_fpath = None, prometheus_fpath = None, interval = export_interval):
+        super().__init__(daemon = True)
+        self.metrics = metrics
+        self.json_fpath = json_fpath
+        self.prometheus_fpath = prometheus_fpath
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def export(self):
+        snapshot = self.metrics.snapshot()
+        if self.json_fpath is not None:
+            self.metrics.write_json_line(self.json_fpath, snapshot)
+        if self.prometheus_fpath is not None:
+            self.metrics.write_prometheus(self.prometheus_fpath, snapshot)
+
+    def start(self):
+        super().start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        if not self._stop_event.is_set():
+            self._stop_event.set()
+            if self.is_alive():
+                self.join()
+            self.export()
+        atexit.unregister(self.stop)
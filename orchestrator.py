@@ -0,0 +1,268 @@
+# coding: utf-8
+
+# Running several bots at once -- one per emulator instance -- each in its own process.
+#
+# Every worker gets its own window (picked by process ID and/or window title, since every emulator window
+# has the same class title) and its own vJoy device. Workers don't ask anyone anything (BotView.interactive is off);
+# what they report (BotView.report()) comes back here:
+#     - results are written to one results file (see results_store),
+#     - alerts (e.g. a potentially good seed) are printed and collected; a worker that raises one stops,
+#       leaving its emulator where it is,
+#     - progress counters (e.g. attempts) are kept per worker and totalled.
+# Workers that crash are started again (up to max_restarts times each).
+#
+#     specs = [orchestrator.WorkerSpec('evaluator_bot:EvaluatorBot', pid = pid, vjoy_device_num = n)
+#              for (n, pid) in enumerate(emulator_pids, start = 1)]
+#     orchestrator.Orchestrator(specs, results_fp = 'results.db').run()
+#
+# Giving WorkerSpecs a simulate source runs them headless instead (see simulation), e.g. for testing;
+# smoke_test() (or `python orchestrator.py`) does that with a couple of simulation.SmokeTestBot workers.
+# (LevelLogger workers should each get their own hist_dir: new screens are numbered per process.)
+
+
+
+import importlib
+import multiprocessing
+import queue
+import tempfile
+import traceback
+from collections import Counter
+from time import perf_counter as _time
+
+import results_store
+
+
+
+max_restarts = 5 # times a crashed worker is started again before it's given up on
+restart_delay = 2.0 # seconds to wait before restarting a crashed worker (e.g. so its emulator can come back)
+poll_interval = 0.25 # seconds Orchestrator.run() waits for news from workers at a time
+
+
+
+class WorkerSpec:
+    """
+    What one worker runs:
+        - bot: 'module:ClassName' of a bot_vision.BotView subclass, e.g. 'seed_finder:SeedFinder' (the module must be importable).
+        - window: class title of the window to look at (default: the module's window_class_title).
+        - pid, title: which of the windows with that class title (see frame_capture.Win32Capture).
+        - vjoy_device_num: the vJoy device to play macros on.
+        - simulate: instead of a window and vJoy device, run headless on this frames source, with script
+            (see simulation.simulate()), for max_macros macros (see simulation.run()).
+        - bot_kwargs: passed on to the bot class (macros defaults to the module's macros_dd).
+    """
+    def __init__(self, bot, window = None, pid = None, title = None, vjoy_device_num = 1,
+            simulate = None, script = None, max_macros = None, **bot_kwargs):
+        self.bot = bot
+        self.window = window
+        self.pid = pid
+        self.title = title
+        self.vjoy_device_num = vjoy_device_num
+        self.simulate = simulate
+        self.script = script
+        self.max_macros = max_macros
+        self.bot_kwargs = bot_kwargs
+
+    def __repr__(self):
+        where = "simulate = {0!r}".format(self.simulate) if self.simulate is not None \
+            else "pid = {0}, title = {1!r}, vjoy_device_num = {2}".format(self.pid, self.title, self.vjoy_device_num)
+        return "WorkerSpec({0!r}, {1})".format(self.bot, where)
+
+
+
+def _run_worker(worker_id, spec, events):
+    """Body of a worker process: build spec's bot, run it, and pass everything it reports to events."""
+    def reporter(kind, data):
+        events.put((worker_id, kind, data))
+
+    try:
+        module_name, class_name = spec.bot.split(':')
+        module = importlib.import_module(module_name)
+        bot_class = getattr(module, class_name)
+        kwargs = dict(spec.bot_kwargs)
+        if 'macros' not in kwargs: # (only touch the module's macros if they're needed)
+            kwargs['macros'] = module.macros_dd
+        if spec.simulate is not None:
+            import simulation
+            bot = simulation.simulate(bot_class, spec.simulate, spec.script, **kwargs)
+        else:
+            import frame_capture
+            import pyvjoy
+            window = spec.window if spec.window is not None else module.window_class_title
+            capture = frame_capture.Win32Capture(window, pid = spec.pid, title = spec.title)
+            bot = bot_class(window = window, capture_backend = capture, controller = pyvjoy.VJoyDevice(spec.vjoy_device_num), **kwargs)
+        bot.reporter = reporter
+        bot.interactive = False
+        if spec.simulate is not None:
+            simulation.run(bot, max_macros = spec.max_macros)
+        else:
+            bot.run()
+    except BaseException:
+        reporter('crash', {'traceback': traceback.format_exc()})
+        raise SystemExit(1)
+
+
+
+class Orchestrator:
+    """
+    Runs a worker process per WorkerSpec and collects what they report (see the top of this module).
+    Attributes:
+        - status: per worker, 'pending', 'running', 'restarting', 'done' (its bot returned) or 'failed' (crashed too often)
+        - progress: per worker, the latest counters it reported (totalled over restarts)
+        - alerts: (worker index, message) for every alert raised
+        - crashes: (worker index, traceback) for every crash
+        - rows: results, if there's no results_fp to write them to
+        - n_results: results received
+    """
+    def __init__(self, specs, results_fp = None, max_restarts = max_restarts, restart_delay = restart_delay):
+        self.specs = list(specs)
+        self.results_fp = results_fp
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        n = len(self.specs)
+        self.status = ['pending'] * n
+        self.restarts = [0] * n
+        self.progress = [Counter() for _ in range(n)]
+        self.alerts = []
+        self.crashes = []
+        self.rows = []
+        self.n_results = 0
+        self._ctx = multiprocessing.get_context('spawn') # (the only option on Windows; keeps workers independent elsewhere)
+        self._events = self._ctx.Queue()
+        self._processes = [None] * n
+        self._current_progress = [Counter() for _ in range(n)] # as reported by the current process
+        self._restart_at = [None] * n
+        self._results = None # results_store sink, opened at the first result
+
+    def start(self):
+        """Start every worker that hasn't been started yet."""
+        for (i, status) in enumerate(self.status):
+            if status == 'pending':
+                self._start_worker(i)
+
+    def run(self, timeout = None):
+        """Start the workers and collect their reports until they're all done or failed (or timeout seconds pass).
+        Workers still running are stopped on the way out (including on a KeyboardInterrupt)."""
+        start = _time()
+        self.start()
+        try:
+            while not self.finished() and (timeout is None or _time() - start < timeout):
+                self.poll(poll_interval)
+        finally:
+            self.stop()
+        return self
+
+    def poll(self, timeout = 0.0):
+        """Handle whatever workers have reported (waiting up to timeout seconds for something),
+        then restart any that crashed."""
+        try:
+            item = self._events.get(timeout = timeout) if timeout else self._events.get_nowait()
+            while True:
+                self._handle(*item)
+                item = self._events.get_nowait()
+        except queue.Empty:
+            pass
+        self._check_workers()
+
+    def finished(self):
+        return all(status in ('done', 'failed') for status in self.status)
+
+    def totals(self):
+        """Every worker's progress counters, added up."""
+        total = Counter()
+        for counters in self.progress:
+            total.update(counters)
+        return total
+
+    def stop(self):
+        """Stop every worker still running, and write out any buffered results."""
+        for (i, process) in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
+                if self.status[i] in ('running', 'restarting'):
+                    self.status[i] = 'pending'
+        self.poll() # whatever was reported before they stopped
+        if self._results is not None:
+            self._results.flush()
+
+    def summary(self):
+        counts = Counter(self.status)
+        return "{0} workers ({1}), {2} results, {3} alerts, {4} crashes, totals: {5}".format(
+            len(self.specs), ', '.join("{0} {1}".format(n, s) for (s, n) in sorted(counts.items())),
+            self.n_results, len(self.alerts), len(self.crashes), dict(self.totals()))
+
+    def _start_worker(self, i):
+        self._current_progress[i] = Counter() # (what earlier runs counted stays in progress[i])
+        process = self._ctx.Process(target = _run_worker, args = (i, self.specs[i], self._events),
+            name = "bot-worker-{0}".format(i), daemon = True)
+        process.start()
+        self._processes[i] = process
+        self.status[i] = 'running'
+        self._restart_at[i] = None
+
+    def _check_workers(self):
+        now = _time()
+        for (i, process) in enumerate(self._processes):
+            if self.status[i] == 'restarting' and now >= self._restart_at[i]:
+                self._start_worker(i)
+            elif self.status[i] == 'running' and not process.is_alive():
+                process.join()
+                if process.exitcode == 0:
+                    self.status[i] = 'done'
+                elif self.restarts[i] < self.max_restarts:
+                    self.restarts[i] += 1
+                    self.status[i] = 'restarting'
+                    self._restart_at[i] = now + self.restart_delay
+                    print("[worker {0}] Crashed (exit code {1}); restarting in {2:.1f} s ({3} of {4}).".format(
+                        i, process.exitcode, self.restart_delay, self.restarts[i], self.max_restarts))
+                else:
+                    self.status[i] = 'failed'
+                    print("[worker {0}] Crashed (exit code {1}) too many times; giving up on it.".format(i, process.exitcode))
+
+    def _handle(self, i, kind, data):
+        if kind == 'progress':
+            self.progress[i].subtract(self._current_progress[i])
+            self._current_progress[i] = Counter(data)
+            self.progress[i].update(self._current_progress[i])
+        elif kind == 'result':
+            self.n_results += 1
+            row = dict(data['row'], worker = i)
+            if self.results_fp is None:
+                self.rows.append(row)
+            else:
+                if self._results is None:
+                    self._results = results_store.open_sink(self.results_fp, ['worker'] + sorted(data['row']))
+                self._results.log(row)
+        elif kind == 'alert':
+            self.alerts.append((i, data['message']))
+            print("[worker {0}] ALERT: {1}".format(i, data['message']))
+        elif kind == 'crash':
+            self.crashes.append((i, data['traceback']))
+            print("[worker {0}] {1}".format(i, data['traceback']))
+
+
+
+def smoke_test(n_workers = 2, n_macros = 4):
+    """
+    Check that simulated workers run in their own (spawned) processes and report back, without Windows or vJoy:
+    n_workers simulation.SmokeTestBot workers each play their made-up macro n_macros times
+    (macros are passed as an unloaded macro_format.PickledMacros, so each worker loads them itself, without pyvjoy).
+    Raises AssertionError if anything's off; returns the Orchestrator.
+    """
+    import macro_format
+    import simulation
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        frames_dir, macros_fpath = simulation.smoke_test_assets(tmp_dir)
+        specs = [WorkerSpec('simulation:SmokeTestBot', simulate = frames_dir, script = [0, 1, 2], max_macros = n_macros,
+                macros = macro_format.open_macros(macros_fpath)) for _ in range(n_workers)]
+        orchestrator = Orchestrator(specs, max_restarts = 0).run(timeout = 60.0)
+    assert not orchestrator.crashes, orchestrator.crashes
+    assert orchestrator.status == ['done'] * n_workers, orchestrator.status
+    # (each worker's last macro ends the simulation before the bot can report it)
+    assert orchestrator.totals()['macros'] == n_workers * (n_macros - 1), orchestrator.totals()
+    return orchestrator
+
+
+
+if __name__ == '__main__':
+    print(smoke_test().summary())
@@ -0,0 +1,241 @@
+# coding: utf-8
+
+# Logging bot results (e.g. LevelLogger's area combinations, one row per seed) at scale.
+#
+# A results sink buffers rows and writes them out a batch at a time:
+#     - CsvSink appends to a CSV file (opened once per batch rather than once per row),
+#     - SqliteSink inserts into an SQLite database, one transaction per batch,
+#       with an index on the combination of columns so lookups and counts don't scan the whole table.
+# open_sink() picks one by file extension.
+#
+# seed_frequencies() counts how often each combination occurs, streaming through the results
+# rather than loading them all.
+#
+# To move an existing CSV into SQLite:
+#     python results_store.py results.csv results.db
+# To print the most frequent combinations in either:
+#     python results_store.py results.db
+
+
+
+import atexit
+import csv
+import os
+import sqlite3
+import sys
+from collections import Counter
+from time import monotonic as _time
+
+
+
+batch_size = 64 # rows buffered before a sink writes them out
+flush_interval = 60.0 # seconds a row can sit in the buffer before the next log() writes it out regardless
+table_name = 'results'
+sqlite_exts = ('.db', '.sqlite', '.sqlite3')
+
+
+
+#########
+## FUNCTIONS
+#########
+
+def open_sink(fpath, fieldnames, **kwargs):
+    """SqliteSink if fpath has one of sqlite_exts, CsvSink otherwise."""
+    if os.path.splitext(fpath)[1].lower() in sqlite_exts:
+        return SqliteSink(fpath, fieldnames, **kwargs)
+    return CsvSink(fpath, fieldnames, **kwargs)
+
+
+def seed_frequencies(fpath, fieldnames = None):
+    """
+    Count the rows in the results file at fpath by combination of fieldnames (default: every column).
+    Yields (combination dict, count), most frequent first.
+
+    For SQLite, the database does the grouping (using the combination index) and rows are yielded as they're read;
+    for CSV, rows are read one at a time, so memory use grows with the number of distinct combinations, not rows
+    (and values come back as strings).
+    """
+    if os.path.splitext(fpath)[1].lower() in sqlite_exts:
+        conn = sqlite3.connect(fpath)
+        try:
+            if fieldnames is None:
+                fieldnames = [row[1] for row in conn.execute('PRAGMA table_info("{0}")'.format(table_name)) if row[1] != 'id']
+            cols = _column_list(fieldnames)
+            cursor = conn.execute('SELECT {0}, COUNT(*) AS n FROM "{1}" GROUP BY {0} ORDER BY n DESC'.format(cols, table_name))
+            for row in cursor:
+                yield dict(zip(fieldnames, row[:-1])), row[-1]
+        finally:
+            conn.close()
+        return
+
+    counts = Counter()
+    with open(fpath, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        if fieldnames is None:
+            fieldnames = header
+        cols = [header.index(name) for name in fieldnames]
+        for row in reader:
+            counts[tuple(row[i] if row[i] != '' else None for i in cols)] += 1
+    for combination, n in counts.most_common():
+        yield dict(zip(fieldnames, combination)), n
+
+
+def import_csv(csv_fpath, db_fpath, batch_size = 4096):
+    """Append every row of a CSV results file to an SQLite results database, a batch at a time."""
+    with open(csv_fpath, newline = '') as f:
+        reader = csv.DictReader(f)
+        with SqliteSink(db_fpath, reader.fieldnames, batch_size = batch_size, flush_interval = None) as sink:
+            for row in reader:
+                sink.log({k: (v if v != '' else None) for (k, v) in row.items()})
+
+
+def _quoted(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def _column_list(fieldnames):
+    return ', '.join(_quoted(name) for name in fieldnames)
+
+
+
+class ResultsSink:
+    """
+    Buffers result rows (dicts keyed by fieldnames) and writes them out batch_size at a time,
+    or at the next log() once flush_interval seconds have passed since the oldest buffered row (None -> never).
+    Whatever is still buffered is written on close(), which also happens at interpreter exit
+    (including after an uncaught exception -- only a process killed outright loses its buffered rows).
+    interactive says whether there's someone at the console close() can ask for help (default: stdin is a terminal).
+    Subclasses implement _write(rows), which should raise (leaving nothing written) if it can't write them.
+    """
+    def __init__(self, fieldnames, batch_size = batch_size, flush_interval = flush_interval, interactive = None):
+        self.fieldnames = list(fieldnames)
+        self.interactive = interactive if interactive is not None else (sys.stdin is not None and sys.stdin.isatty())
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.n_logged = 0
+        self.n_written = 0
+        self._buffer = []
+        self._buffered_since = None
+        atexit.register(self.close)
+
+    def log(self, row):
+        """Buffer row (missing fields are left empty)."""
+        self._buffer.append([row.get(name) for name in self.fieldnames])
+        self.n_logged += 1
+        if self._buffered_since is None:
+            self._buffered_since = _time()
+        if len(self._buffer) >= self.batch_size \
+                or (self.flush_interval is not None and _time() - self._buffered_since >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write out whatever is buffered."""
+        if self._buffer:
+            self._write(self._buffer)
+            self.n_written += len(self._buffer)
+            self._buffer = []
+            self._buffered_since = None
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.close)
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+class CsvSink(ResultsSink):
+    """
+    Appends results to a CSV file (writing the header first if the file is new or empty).
+    The file is only open while a batch is being written, so it can be viewed (e.g. in Excel) in between;
+    if it's locked when a batch is due, the rows stay buffered and are retried at the next flush.
+    If it's still locked on close(), someone at the console (if interactive) is asked to close it;
+    otherwise the rows are printed to stderr rather than lost silently.
+    """
+    def __init__(self, fpath, fieldnames, **kwargs):
+        super().__init__(fieldnames, **kwargs)
+        self.fpath = fpath
+
+    def flush(self):
+        try:
+            super().flush()
+        except PermissionError: # CSV is currently open
+            print("Output CSV currently locked! {0} results will be written once it's closed.".format(len(self._buffer)))
+
+    def close(self):
+        self.flush()
+        while self._buffer and self.interactive:
+            try:
+                input("Output CSV currently open! Close and press Enter to retry.\n")
+            except EOFError: # nobody there after all
+                break
+            self.flush()
+        if self._buffer:
+            print("Couldn't write {0} results to {1}; here they are instead:".format(len(self._buffer), self.fpath), file = sys.stderr)
+            writer = csv.writer(sys.stderr)
+            writer.writerow(self.fieldnames)
+            writer.writerows(self._buffer)
+            self._buffer = []
+        super().close()
+
+    def _write(self, rows):
+        with open(self.fpath, mode = 'a', newline = '') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(self.fieldnames)
+            writer.writerows(rows)
+
+
+
+class SqliteSink(ResultsSink):
+    """
+    Inserts results into table_name of an SQLite database, one transaction per batch.
+    Each field is a column; an index on all of them together keeps combination lookups and counts fast.
+    """
+    def __init__(self, fpath, fieldnames, batch_size = 256, **kwargs):
+        super().__init__(fieldnames, batch_size = batch_size, **kwargs)
+        self.fpath = fpath
+        self._conn = sqlite3.connect(fpath)
+        self._conn.execute('PRAGMA journal_mode = WAL') # readers (e.g. seed_frequencies()) don't block logging
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        cols = _column_list(self.fieldnames)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS "{0}" (id INTEGER PRIMARY KEY, {1})'.format(
+                table_name, ', '.join(_quoted(name) + ' INTEGER' for name in self.fieldnames)))
+            self._conn.execute('CREATE INDEX IF NOT EXISTS "{0}_combination" ON "{0}" ({1})'.format(table_name, cols))
+        self._insert = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(table_name, cols, ', '.join('?' * len(self.fieldnames)))
+
+    def close(self):
+        if self._conn is not None:
+            super().close()
+            self._conn.close()
+            self._conn = None
+
+    def _write(self, rows):
+        with self._conn: # one transaction; rolled back if anything fails
+            self._conn.executemany(self._insert, rows)
+
+
+
+if __name__ == '__main__':
+    from sys import argv
+    if len(argv) == 3:
+        import_csv(argv[1], argv[2])
+    elif len(argv) == 2:
+        for i, (combination, n) in enumerate(seed_frequencies(argv[1])):
+            if i == 20:
+                break
+            print(n, combination)
+    else:
+        print("Usage: python results_store.py <results.csv> <results.db>  (import)\n"
+            "       python results_store.py <results file>            (most frequent combinations)")
@@ -0,0 +1,236 @@
+# coding: utf-8
+
+# Running bots headless, without Windows, an emulator or vJoy.
+#
+# FakeVJoyDevice stands in for pyvjoy.VJoyDevice: it records every set_data()/update()/reset() call with a timestamp
+# and tells its listeners about each one. A frame_capture.ScriptedCapture listening to it steps through recorded frames
+# as macros are played, so the bot "sees" the game react to its input.
+#
+# simulate() builds a bot (EvaluatorBot, LevelLogger, SeedFinder, ...) wired up that way,
+# with macros played on simulated time (macro_handler.VirtualScheduler), i.e. as fast as the bot can decide.
+# Waiting for a macro checkpoint is simulated too: each poll that misses steps the frames along (see ScriptedCapture).
+# run() runs it for a number of macros and reports throughput:
+#
+#     import simulation, seed_finder as sf
+#     bot = simulation.simulate(sf.SeedFinder, 'recorded_frames', macros = sf.macros_dd)
+#     print(simulation.run(bot, max_macros = 400))
+#
+# A macro with checkpoints (see macro_handler.add_checkpoint()) can be tried out on a script that shows its
+# checkpoint's screen after a few frames of loading, e.g. script = [0, 1, 1, 2] with frame 2 showing the template:
+# the checkpoint is passed once the polls have stepped through to it, or times out (in simulated time) if it never shows.
+#
+# smoke_test() (or `python simulation.py`) checks all of that end to end on generated frames and a made-up macro
+# (orchestrator.smoke_test() does the same in worker processes).
+
+
+
+import os
+import pickle
+import tempfile
+from collections import deque
+from time import perf_counter as _time
+
+import cv2
+import numpy as np
+
+import bot_vision
+import frame_capture
+import macro_format
+import macro_handler
+
+
+
+class StopSimulation(Exception):
+    """Raised (by run()) through a bot's run() to end a simulation."""
+    pass
+
+
+
+class _FakeData:
+    """Stand-in for VJoyDevice.Data."""
+    def __init__(self, device):
+        self._device = device
+        self.state = None # the state last passed to set_data()
+
+    def set_data(self, state):
+        self.state = state
+        self._device._record('set_data', state)
+
+
+
+class FakeVJoyDevice:
+    """
+    Stand-in for pyvjoy.VJoyDevice that records what it's asked to do.
+    self.calls holds (time, event, state) for every 'set_data', 'update' and 'reset' call
+    (the most recent max_calls of them, if given), where state is a copy of the state at the time (None for 'reset').
+    Each call is also passed on, as listener(event, time, state), to every callable in self.listeners.
+    Times come from clock (e.g. a macro_handler.VirtualScheduler's now).
+    """
+    def __init__(self, rID = 1, clock = _time, max_calls = None):
+        self.rID = rID
+        self.clock = clock
+        self.Data = _FakeData(self)
+        self.calls = deque(maxlen = max_calls)
+        self.listeners = []
+        self.n_updates = 0
+        self.n_resets = 0
+
+    def update(self):
+        self.n_updates += 1
+        self._record('update', self.Data.state)
+
+    def reset(self):
+        self.n_resets += 1
+        self.Data.state = None
+        self._record('reset', None)
+
+    def updates(self):
+        """macro_format.state_dtype structured array of the recorded updates (times as given by clock)."""
+        updates = [(t, state) for (t, event, state) in self.calls if event == 'update']
+        return macro_format.states_to_columns([state for (_, state) in updates], [t for (t, _) in updates])
+
+    def _record(self, event, state):
+        t = self.clock()
+        if state is not None:
+            state = type(state).from_buffer_copy(state)
+        self.calls.append((t, event, state))
+        for listener in self.listeners:
+            listener(event, t, state)
+
+
+
+class SimulationStats:
+    """
+    What run() got through:
+        - n_macros, n_updates: macros played and controller updates issued
+        - wall_time: seconds it actually took
+        - simulated_time: seconds it would have taken in real time (by the controller's clock)
+    """
+    def __init__(self, n_macros, n_updates, wall_time, simulated_time):
+        self.n_macros = n_macros
+        self.n_updates = n_updates
+        self.wall_time = wall_time
+        self.simulated_time = simulated_time
+
+    @property
+    def macros_per_second(self):
+        return self.n_macros / self.wall_time if self.wall_time else 0.0
+
+    def __str__(self):
+        return "{0} macros ({1} updates) in {2:.2f} s ({3:.1f} macros/s), {4:.1f} s simulated".format(
+            self.n_macros, self.n_updates, self.wall_time, self.macros_per_second, self.simulated_time)
+
+
+
+class SmokeTestBot(bot_vision.BotView):
+    """Bare bot for smoke_test(): plays the 'smoke' macro (see smoke_test_assets()) over and over, reporting progress."""
+    def run(self):
+        n = 0
+        while True:
+            stats = self.run_macro('smoke')
+            assert stats.checkpoints_passed == 1 and not stats.aborted, stats
+            n += 1
+            self.report('progress', macros = n)
+            self.update_view()
+
+
+
+#########
+## FUNCTIONS
+#########
+
+def simulate(bot_class, source, script = None, advance_on = 'reset', realtime = False, **bot_kwargs):
+    """
+    Build a bot_class (a bot_vision.BotView subclass) that sees frames from source and plays macros on a FakeVJoyDevice.
+    Inputs:
+        - source, script, advance_on: how frames are stepped through as macros are played (see frame_capture.ScriptedCapture).
+        - realtime: play macros in real time (macro_handler.SpinScheduler) instead of simulated time.
+        - bot_kwargs: passed on to bot_class (e.g. macros).
+    """
+    scheduler = macro_handler.SpinScheduler() if realtime else macro_handler.VirtualScheduler()
+    capture = frame_capture.ScriptedCapture(source, script, advance_on)
+    controller = FakeVJoyDevice(clock = scheduler.now)
+    controller.listeners.append(capture.on_input)
+    if not realtime:
+        scheduler.listeners.append(capture.on_input) # checkpoint polls that miss move the frames along
+    bot = bot_class(window = None, capture_backend = capture, controller = controller, **bot_kwargs)
+    bot.scheduler = scheduler
+    bot.interactive = False # no one to ask (and no Windows dialogs to ask with)
+    return bot
+
+
+def run(bot, max_macros = None, max_seconds = None):
+    """
+    Call bot.run() (of a bot built by simulate()) until max_macros macros have been played
+    or max_seconds (of wall time) have passed, whichever comes first. Returns a SimulationStats.
+    """
+    controller = bot.controller
+    n_resets, n_updates, clock_start = controller.n_resets, controller.n_updates, controller.clock()
+    start = _time()
+
+    def stop_when_done(event, t, state):
+        if event != 'reset':
+            return
+        if (max_macros is not None and controller.n_resets - n_resets >= max_macros) \
+                or (max_seconds is not None and _time() - start >= max_seconds):
+            raise StopSimulation()
+
+    controller.listeners.append(stop_when_done)
+    try:
+        bot.run()
+    except StopSimulation:
+        pass
+    finally:
+        controller.listeners.remove(stop_when_done)
+    return SimulationStats(controller.n_resets - n_resets, controller.n_updates - n_updates,
+        _time() - start, controller.clock() - clock_start)
+
+
+def smoke_test_assets(tmp_dir):
+    """
+    Write what smoke_test() needs into tmp_dir: a directory of 3 generated frames, a checkpoint template
+    (part of the last frame) and a pickled macro dictionary whose 'smoke' macro waits for it halfway through.
+    Returns (frames directory, macro dictionary file), for simulate(SmokeTestBot, ..., script = [0, 1, 2]).
+    """
+    frames_dir = os.path.join(tmp_dir, 'frames')
+    os.mkdir(frames_dir)
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        cv2.imwrite(os.path.join(frames_dir, 'frame{0}.png'.format(i)), rng.integers(0, 256, (120, 160, 3), dtype = np.uint8))
+    template_fpath = os.path.join(tmp_dir, 'checkpoint.png')
+    cv2.imwrite(template_fpath, cv2.imread(os.path.join(frames_dir, 'frame2.png'))[40:80, 60:100])
+
+    columns = np.zeros(60, dtype = macro_format.state_dtype)
+    columns['time'] = np.arange(60) / 60
+    columns[macro_format.button_label][20:40] = 1
+    macro = macro_format.columns_to_macro(columns, hz = 60) # (pyvjoy's structs if it's installed)
+    macro_handler.add_checkpoint(macro, 0.5, template_fpath, region = (40, 20, 80, 80), timeout = 1.0)
+    macros_fpath = os.path.join(tmp_dir, 'macro_dd.p')
+    with open(macros_fpath, mode = 'wb') as f:
+        pickle.dump({'smoke': macro}, f)
+    return frames_dir, macros_fpath
+
+
+def smoke_test(n_macros = 8):
+    """
+    Check that a bot can be simulated with nothing but this repo (no Windows, vJoy, recorded frames or macros):
+    a SmokeTestBot plays a made-up macro with a checkpoint n_macros times, on generated frames (see smoke_test_assets()).
+    The checkpoint's screen only shows up a couple of polls into the first macro.
+    Raises AssertionError if anything's off; returns the SimulationStats.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        frames_dir, macros_fpath = smoke_test_assets(tmp_dir)
+        bot = simulate(SmokeTestBot, frames_dir, script = [0, 1, 2], macros = macro_format.open_macros(macros_fpath))
+        stats = run(bot, max_macros = n_macros)
+    assert not bot.interactive
+    assert stats.n_macros == n_macros, stats
+    last = bot.last_macro_stats
+    assert last.n_updates + last.updates_saved == 60, last # (fewer updates if macros are coalesced)
+    presses = bot.controller.updates()[macro_format.button_label].sum()
+    assert presses == n_macros * (1 if bot_vision.coalesce_macros else 20), presses
+    return stats
+
+
+
+if __name__ == '__main__':
+    print(smoke_test())
@@ -0,0 +1,166 @@
+# coding: utf-8
+
+# Saving frames to disk without holding up the bot.
+#
+# SnapshotWriter takes frames off the bot's hands and writes them on a background thread,
+# so disk I/O doesn't stall the macro timeline. The format follows the file extension:
+# .png (at a chosen compression level), .npy (raw array, fastest), or anything else cv2.imwrite() knows (e.g. .bmp).
+#
+# read_snapshot() reads any of those back -- including snapshots still waiting to be written,
+# and ones that couldn't be written (which are kept in memory, and reported by the writer's next save()/flush()/close()).
+
+
+
+import atexit
+import os
+import queue
+import threading
+from time import perf_counter as _time
+
+import numpy as np
+import cv2
+
+
+
+png_compression = 1 # 0 (none, fastest) - 9 (smallest, slowest); cv2's default is 3
+max_pending = 8 # frames that can wait to be written before save() blocks
+
+_pending = {} # fpath -> frame, for every snapshot queued but not yet written (or that failed to be) by any writer
+_pending_lock = threading.Lock()
+
+
+
+class SnapshotError(IOError):
+    """Raised by SnapshotWriter when snapshots saved earlier couldn't be written.
+    fpaths lists them; their frames can still be read with read_snapshot()."""
+    def __init__(self, message, fpaths):
+        super().__init__(message)
+        self.fpaths = fpaths
+
+
+
+def write_snapshot(fpath, frame, png_compression = png_compression):
+    """Write a BGR frame to fpath in the format its extension implies."""
+    ext = os.path.splitext(fpath)[1].lower()
+    if ext == '.npy':
+        np.save(fpath, frame)
+    elif ext == '.png':
+        if not cv2.imwrite(fpath, frame, [cv2.IMWRITE_PNG_COMPRESSION, png_compression]):
+            raise IOError("Couldn't write {0}.".format(fpath))
+    elif not cv2.imwrite(fpath, frame):
+        raise IOError("Couldn't write {0}.".format(fpath))
+
+
+def read_snapshot(fpath):
+    """Read a BGR frame written by write_snapshot() (or still queued in a SnapshotWriter). None if unreadable."""
+    with _pending_lock:
+        frame = _pending.get(fpath)
+    if frame is not None:
+        return frame
+    if fpath.lower().endswith('.npy'):
+        return np.load(fpath) if os.path.exists(fpath) else None
+    return cv2.imread(fpath)
+
+
+
+class SnapshotWriter:
+    """
+    Writes frames to disk on a background thread.
+
+    save() copies the frame and queues it; once max_pending frames are waiting, it blocks until one is written
+    (backpressure, so a slow disk can't eat all the memory). Everything queued is written before
+    the interpreter exits, or whenever flush() / close() is called.
+
+    Metrics:
+        - n_written: snapshots written
+        - mean_latency, max_latency: seconds from save() to the file being written
+        - n_stalls, stall_time: how often (and for how long, in seconds) save() had to wait for the queue
+        - errors: (fpath, exception) for writes that failed
+
+    A failed write's frame stays in memory (so read_snapshot() still finds it),
+    and the next save(), flush() or close() raises a SnapshotError about it.
+    """
+    def __init__(self, max_pending = max_pending, png_compression = png_compression):
+        self.png_compression = png_compression
+        self.n_written = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.n_stalls = 0
+        self.stall_time = 0.0
+        self.errors = []
+        self._unreported = [] # errors not raised by save()/flush()/close() yet
+        self._queue = queue.Queue(maxsize = max_pending)
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.n_written if self.n_written else 0.0
+
+    def save(self, frame, fpath):
+        """Queue a copy of frame to be written to fpath.
+        Raises a SnapshotError (having queued the frame regardless) if earlier snapshots couldn't be written."""
+        if not self._thread.is_alive():
+            raise RuntimeError("SnapshotWriter is closed.")
+        frame = frame.copy()
+        with _pending_lock:
+            _pending[fpath] = frame
+        item = (fpath, frame, _time())
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full: # backpressure
+            start = _time()
+            self._queue.put(item)
+            self.n_stalls += 1
+            self.stall_time += _time() - start
+        self._raise_errors()
+
+    def flush(self):
+        """Block until everything queued so far has been written (raising a SnapshotError if anything couldn't be)."""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Write everything still queued, then stop the writer thread (raising a SnapshotError if anything couldn't be written)."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        atexit.unregister(self.close)
+        self._raise_errors()
+
+    def summary(self):
+        return "{0} snapshots written, latency mean {1:.1f} ms / max {2:.1f} ms, {3} stalls ({4:.2f} s), {5} errors".format(
+            self.n_written, 1000 * self.mean_latency, 1000 * self.max_latency, self.n_stalls, self.stall_time, len(self.errors))
+
+    def _raise_errors(self):
+        if not self._unreported:
+            return
+        errors, self._unreported = self._unreported, []
+        fpath, e = errors[0]
+        more = " (and {0} more)".format(len(errors) - 1) if len(errors) > 1 else ''
+        raise SnapshotError("Failed to write snapshot {0}{1} (kept in memory instead): {2}".format(fpath, more, e),
+            [fpath for (fpath, _) in errors]) from e
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            fpath, frame, queued_at = item
+            try:
+                write_snapshot(fpath, frame, self.png_compression)
+            except Exception as e:
+                self.errors.append((fpath, e))
+                self._unreported.append((fpath, e)) # (the frame stays in _pending)
+            else:
+                latency = _time() - queued_at
+                self.n_written += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                with _pending_lock:
+                    if _pending.get(fpath) is frame:
+                        del _pending[fpath]
+            finally:
+                self._queue.task_done()
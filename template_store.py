@@ -0,0 +1,193 @@
+# coding: utf-8
+
+# Keeping large, growing sets of full-screen templates (e.g. LevelLogger's history) manageable.
+#
+# FingerprintIndex keeps a small perceptual hash of every template,
+# so a new screen only has to be compared (with cv2.matchTemplate) against the few templates
+# whose hashes are closest to its own, instead of against everything seen so far.
+# The hashes are kept in a text file next to the templates, so they're only computed once.
+#
+# TemplateStore holds the templates themselves within a memory budget:
+# recently used ones stay decoded, the rest are dropped and read back from disk when next needed.
+
+
+
+import os
+from collections import OrderedDict
+import numpy as np
+import cv2
+import snapshots
+
+
+
+hash_size = 16 # fingerprints are hash_size x hash_size bits
+n_candidates = 4 # how many of the closest fingerprints FingerprintIndex.candidates() returns by default
+max_distance = 32 # bits (of hash_size**2) a screen's fingerprint can differ from a match's (e.g. by animations)
+default_budget = 512 * 2**20 # bytes of decoded templates a TemplateStore keeps by default
+
+
+
+def fingerprint(im, hash_size = hash_size):
+    """
+    Difference hash of a BGR image: shrink to (hash_size + 1) x hash_size grayscale,
+    then record whether each pixel is brighter than its left neighbor.
+    Returns the bits packed into a uint8 np.ndarray.
+    Near-identical images give hashes a small Hamming distance apart.
+    """
+    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation = cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of templates, grouped (e.g. by area), for quickly finding likely matches.
+
+    Fingerprints are cached in index_fpath (one "filename<TAB>size<TAB>mtime_ns<TAB>hex" line per template,
+    appended as templates are added), so templates already in it don't need to be hashed (or even decoded) again.
+    An entry is only trusted while the file's size and mtime still match; entries for files no longer in
+    index_fpath's directory (where the templates are expected to be) are dropped when the index is loaded.
+    """
+    def __init__(self, index_fpath):
+        self.index_fpath = index_fpath
+        self._known = {} # filename (no directory) -> ((size, mtime_ns), fingerprint), as read from index_fpath
+        self._fpaths = {} # group -> list of template fpaths
+        self._hashes = {} # group -> (buffer, n): the first n rows of buffer (uint8) match self._fpaths[group]
+        if os.path.exists(index_fpath):
+            self._load()
+
+    def _load(self):
+        """Read index_fpath, then rewrite it if it had stale, superseded or unreadable lines."""
+        template_dir = os.path.dirname(self.index_fpath)
+        n_lines = 0
+        with open(self.index_fpath) as f:
+            for line in f:
+                n_lines += 1
+                fields = line.strip().split('\t')
+                if len(fields) != 4: # (including the old "filename<TAB>hex" lines, which get hashed again)
+                    continue
+                fn, size, mtime_ns, hex_hash = fields
+                self._known[fn] = ((int(size), int(mtime_ns)), np.frombuffer(bytes.fromhex(hex_hash), dtype = np.uint8))
+        for fn in [fn for fn in self._known if not os.path.exists(os.path.join(template_dir, fn))]:
+            del self._known[fn]
+        if len(self._known) < n_lines:
+            with open(self.index_fpath, mode = 'w') as f:
+                for (fn, (stamp, h)) in self._known.items():
+                    f.write(_index_line(fn, stamp, h))
+
+    def _lookup(self, fpath):
+        """fpath's cached fingerprint, if the file hasn't changed since it was hashed (otherwise None)."""
+        entry = self._known.get(os.path.basename(fpath))
+        if entry is None or entry[0] != _stamp(fpath):
+            return None
+        return entry[1]
+
+    def add(self, group, fpath, im = None):
+        """
+        Add the template at fpath to group.
+        im is the template itself (BGR); it's only needed (and loaded from fpath if not given)
+        if fpath isn't in the index file yet (or has changed since).
+        """
+        h = self._lookup(fpath)
+        if h is None:
+            h = fingerprint(im if im is not None else snapshots.read_snapshot(fpath))
+            stamp = _stamp(fpath)
+            if stamp is not None: # (not if it's still waiting to be written -- it'll be hashed again next time)
+                fn = os.path.basename(fpath)
+                self._known[fn] = (stamp, h)
+                with open(self.index_fpath, mode = 'a') as f:
+                    f.write(_index_line(fn, stamp, h))
+        self._fpaths.setdefault(group, []).append(fpath)
+        buffer, n = self._hashes.get(group, (None, 0))
+        if buffer is None or n == len(buffer): # full -- grow by doubling, so adding stays cheap as the history grows
+            grown = np.empty((max(16, 2 * n), h.size), dtype = np.uint8)
+            if n:
+                grown[:n] = buffer[:n]
+            buffer = grown
+        buffer[n] = h
+        self._hashes[group] = (buffer, n + 1)
+
+    def needs_image(self, fpath):
+        """Whether add() would need the template's image to fingerprint it."""
+        return self._lookup(fpath) is None
+
+    def candidates(self, group, im, n = n_candidates, max_distance = None):
+        """fpaths of (up to) the n templates in group with fingerprints closest to im's, closest first.
+        If max_distance is given, only templates whose fingerprints are at most that many bits off are returned."""
+        buffer, count = self._hashes.get(group, (None, 0))
+        if not count:
+            return []
+        distances = np.unpackbits(buffer[:count] ^ fingerprint(im), axis = 1).sum(axis = 1)
+        order = np.argsort(distances, kind = 'stable')[:n]
+        return [self._fpaths[group][i] for i in order if max_distance is None or distances[i] <= max_distance]
+
+
+
+def _stamp(fpath):
+    """(size, mtime_ns) of the file at fpath, or None if it doesn't exist (yet)."""
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _index_line(fn, stamp, h):
+    return "{0}\t{1}\t{2}\t{3}\n".format(fn, stamp[0], stamp[1], h.tobytes().hex())
+
+
+
+class TemplateStore:
+    """
+    Templates stored as image (or .npy) files, grouped (e.g. by area), decoded on demand.
+    store[fpath] gives the (BGR) template. Decoded templates are kept, least recently used first out,
+    as long as they fit in max_bytes; evicted ones are read from fpath again the next time they're needed.
+    hits/misses count lookups that were/weren't already decoded.
+    """
+    def __init__(self, max_bytes = default_budget):
+        self.max_bytes = max_bytes
+        self.nbytes = 0 # bytes currently decoded
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._groups = {} # group -> list of fpaths
+        self._cache = OrderedDict() # fpath -> template, least recently used first
+
+    def add(self, group, fpath, im = None):
+        """Add the template at fpath to group. If im (the decoded template) is given, it's kept as if just used."""
+        self._groups.setdefault(group, []).append(fpath)
+        if im is not None:
+            self._insert(fpath, im)
+
+    def fpaths(self, group):
+        """fpaths of every template in group, in the order they were added."""
+        return list(self._groups.get(group, []))
+
+    def __getitem__(self, fpath):
+        im = self._cache.get(fpath)
+        if im is not None:
+            self.hits += 1
+            self._cache.move_to_end(fpath)
+            return im
+        self.misses += 1
+        im = snapshots.read_snapshot(fpath)
+        if im is None:
+            raise KeyError(fpath)
+        self._insert(fpath, im)
+        return im
+
+    def summary(self):
+        return "{0} templates decoded ({1:.1f} MB of {2:.1f} MB), {3} hits / {4} misses / {5} evictions".format(
+            len(self._cache), self.nbytes / 2**20, self.max_bytes / 2**20, self.hits, self.misses, self.evictions)
+
+    def _insert(self, fpath, im):
+        old = self._cache.pop(fpath, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self._cache[fpath] = im
+        self.nbytes += im.nbytes
+        while self.nbytes > self.max_bytes and len(self._cache) > 1: # (always keep the one just inserted)
+            _, evicted = self._cache.popitem(last = False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1